@@ -0,0 +1,109 @@
+"""
+Admission control for story generation
+
+Tracks in-flight generations and recent upstream (Groq) latency, and decides
+per request whether to accept it, serve a degraded response, or shed it with
+a fast 503. Authenticated users get a larger share of capacity than anonymous
+ones. Every decision is counted so overload behavior can be inspected.
+
+Counters and limits are per worker process. Thresholds can be overridden
+with environment variables of the same name.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import deque
+
+
+# =============================================================================
+# THRESHOLDS
+# =============================================================================
+
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 16))  # Authenticated hard limit
+ANON_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_ANON_MAX_IN_FLIGHT', 8))  # Anonymous hard limit
+DEGRADE_IN_FLIGHT = int(os.environ.get('ADMISSION_DEGRADE_IN_FLIGHT', 8))  # Start degrading above this
+DEGRADE_LATENCY_SECONDS = float(os.environ.get('ADMISSION_DEGRADE_LATENCY_SECONDS', 20))
+SHED_LATENCY_SECONDS = float(os.environ.get('ADMISSION_SHED_LATENCY_SECONDS', 40))  # Anonymous only
+LATENCY_WINDOW_SECONDS = 60  # Only upstream calls this recent count towards latency
+LATENCY_SAMPLES = 20
+DEGRADED_MAX_LENGTH = 3  # Minutes; degraded generations are capped to this length
+MIN_RETRY_AFTER_SECONDS = 5
+
+ACCEPT = "accept"
+DEGRADE = "degrade"
+REJECT = "reject"
+
+
+class AdmissionController:
+    """Thread-safe admission decisions for /generate."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.in_flight = 0
+        self.counters = {}
+
+    def admit(self, authenticated: bool) -> str:
+        """
+        Decide whether a generation may start.
+
+        Returns ACCEPT or DEGRADE (the caller must call release() when done),
+        or REJECT (nothing to release).
+        """
+        with self._lock:
+            latency = self._recent_latency()
+            limit = MAX_IN_FLIGHT if authenticated else ANON_MAX_IN_FLIGHT
+            if self.in_flight >= limit or (not authenticated and latency >= SHED_LATENCY_SECONDS):
+                self._count('rejected_authenticated' if authenticated else 'rejected_anonymous')
+                return REJECT
+
+            self.in_flight += 1
+            if self.in_flight > DEGRADE_IN_FLIGHT or latency >= DEGRADE_LATENCY_SECONDS:
+                # Counted by the caller: 'degraded_*' for what it actually degraded,
+                # or 'accepted' if nothing needed degrading
+                return DEGRADE
+
+            self._count('accepted')
+            return ACCEPT
+
+    def release(self):
+        """Mark an admitted generation as finished."""
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def record_latency(self, seconds: float):
+        """Record how long an upstream generation call took."""
+        with self._lock:
+            self._latencies.append((time.monotonic(), seconds))
+
+    def count(self, name: str):
+        """Count a decision made by the caller (e.g. which degradation was applied)."""
+        with self._lock:
+            self._count(name)
+
+    def retry_after(self) -> int:
+        """Seconds a shed client should wait before retrying."""
+        with self._lock:
+            return max(MIN_RETRY_AFTER_SECONDS, math.ceil(self._recent_latency()))
+
+    def stats(self) -> dict:
+        """Snapshot of the current load and decision counters."""
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "recent_latency_seconds": round(self._recent_latency(), 2),
+                "counters": dict(self.counters)
+            }
+
+    def _count(self, name):
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _recent_latency(self) -> float:
+        """Average latency of recent upstream calls (0 if none are recent)."""
+        cutoff = time.monotonic() - LATENCY_WINDOW_SECONDS
+        recent = [seconds for recorded_at, seconds in self._latencies if recorded_at >= cutoff]
+        if not recent:
+            return 0.0
+        return sum(recent) / len(recent)
@@ -1,93 +1,40 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+import gzip
+import json
 import os
-import sqlite3
+import time
+import zlib
 from groq import Groq
 from dotenv import load_dotenv
-from llm_config import MODEL_NAME, TEMPERATURE, MAX_TOKENS, SYSTEM_PROMPT, build_story_prompt, get_random_classic_tale
+from llm_config import MODEL_NAME, TEMPERATURE, MAX_TOKENS, TOKENS_PER_WORD, SYSTEM_PROMPT, build_story_prompt, build_personalization, get_random_classic_tale, estimate_words_from_minutes
 from auth import hash_password, verify_password, generate_token
+from calibration import get_calibration, record_generation, token_budget
 from translation import translate_story, SUPPORTED_LANGUAGES
+from admission import AdmissionController, REJECT, DEGRADE, DEGRADED_MAX_LENGTH
+from inbox import claim_inbox_story, get_inbox_stats
+from db import get_repository
+from similarity import SimilarityIndex, SIMILARITY_ENABLED, MIN_RATING, shares_stories
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
 
-# Database setup
-DATABASE = 'stories.db'
-
-def get_db():
-    """Get database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-    return conn
-
-def init_db():
-    """Initialize the database with required tables."""
-    conn = get_db()
-
-    # Users table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            display_name TEXT,
-            token TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Saved stories table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS saved_stories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT,
-            story_text TEXT NOT NULL,
-            story_type TEXT,
-            language TEXT,
-            length_minutes INTEGER,
-            modifications TEXT,
-            rating INTEGER CHECK(rating >= 1 AND rating <= 5),
-            saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-
-    # User settings table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            tones TEXT,
-            tone_custom TEXT,
-            favorite_topics TEXT,
-            child_age INTEGER DEFAULT 6,
-            preferred_language TEXT DEFAULT 'English',
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-
-    # Migration: Add preferred_language column if updating from old schema
-    try:
-        conn.execute("ALTER TABLE user_settings ADD COLUMN preferred_language TEXT DEFAULT 'English'")
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-
-    # Migration: Add user_id column if updating from old schema
-    try:
-        conn.execute('ALTER TABLE saved_stories ADD COLUMN user_id INTEGER')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-
-    conn.commit()
-    conn.close()
+# Database setup (backend chosen by STORAGE_BACKEND, see db.py)
+repo = get_repository()
 
 # Initialize database on startup
-init_db()
+repo.init_schema()
 
 # Initialize Groq client
 client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
 
+# Sheds or degrades /generate when upstream is slow or too many calls are in flight
+admission = AdmissionController()
+
+# Reuses highly rated stories for near-duplicate original_about requests (opt-in)
+similar_stories = SimilarityIndex()
+
 def generate_story(story_type, length_minutes, modifications="", settings=None, classic_tale_id=None):
     """Generate a bedtime story using Groq API (always in English)"""
 
@@ -111,23 +58,51 @@ def generate_story(story_type, length_minutes, modifications="", settings=None,
         except Exception:
             pass  # Continue without specific tale if error
 
+    # Correct the word target and size the token budget from past generations
+    calibration = {"word_factor": 1.0, "tokens_per_word": TOKENS_PER_WORD, "source": "default"}
+    try:
+        calibration = get_calibration(repo, MODEL_NAME, story_type, length_minutes)
+    except Exception:
+        pass  # Fall back to uncalibrated defaults
+
+    target_words = estimate_words_from_minutes(length_minutes)
+    prompted_words = estimate_words_from_minutes(length_minutes, calibration['word_factor'])
+    max_tokens = token_budget(calibration, target_words)
+
     # Build prompt using config (always English)
-    prompt = build_story_prompt(story_type, length_minutes, modifications, settings, classic_tale_title)
+    prompt = build_story_prompt(story_type, length_minutes, modifications, settings, classic_tale_title, calibration['word_factor'])
 
     try:
-        # Call Groq API with settings from llm_config
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            model=MODEL_NAME,
-            temperature=TEMPERATURE,
-            max_tokens=MAX_TOKENS,
-        )
-
-        story = chat_completion.choices[0].message.content
-        return {"success": True, "story": story}
+        while True:
+            # Call Groq API with settings from llm_config
+            chat_completion = client.chat.completions.create(
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                model=MODEL_NAME,
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens,
+            )
+
+            choice = chat_completion.choices[0]
+            story = choice.message.content
+
+            try:
+                record_generation(repo, MODEL_NAME, story_type, length_minutes, target_words, prompted_words,
+                                  story, max_tokens, getattr(chat_completion, 'usage', None), choice.finish_reason)
+            except Exception as e:
+                print(f"Calibration record error: {e}")
+
+            # A story cut off by a calibrated budget gets one retry with the full budget
+            if choice.finish_reason != "length" or max_tokens >= MAX_TOKENS:
+                break
+            max_tokens = MAX_TOKENS
+
+        result = {"success": True, "story": story}
+        if choice.finish_reason == "length":
+            result['truncated'] = True  # Even MAX_TOKENS wasn't enough
+        return result
 
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -136,6 +111,16 @@ def generate_story(story_type, length_minutes, modifications="", settings=None,
 def home():
     return render_template('index.html')
 
+def format_stored_story(title, story_text):
+    """
+    Rebuild the generated-story format (title line, blank line, body) for a
+    saved story. Clients save the body without the title and read the title
+    from the first line of /generate's response.
+    """
+    if title:
+        return f"{title}\n\n{story_text}"
+    return story_text
+
 @app.route('/generate', methods=['POST'])
 def generate():
     data = request.json
@@ -147,36 +132,138 @@ def generate():
 
     # Fetch user settings if logged in
     user_settings = None
+    authenticated = False
     preferred_language = "English"  # Default for non-logged-in users
     user_id = data.get('user_id')
     token = data.get('token')
 
     if user_id and token:
         try:
-            conn = get_db()
             # Verify token
-            user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-            if user:
-                settings_row = conn.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
-                if settings_row:
-                    user_settings = dict(settings_row)
+            if repo.verify_token(user_id, token):
+                authenticated = True
+                user_settings = repo.get_settings(user_id)
+                if user_settings:
                     preferred_language = user_settings.get('preferred_language') or 'English'
-            conn.close()
         except Exception:
             pass  # Continue without settings if there's an error
 
-    # Generate story in English
-    result = generate_story(story_type, length, modifications, user_settings, classic_tale_id)
+    # Users who generate but never save still count as active for pre-generation
+    if authenticated:
+        try:
+            repo.record_activity(user_id)
+        except Exception as e:
+            print(f"Activity record error: {e}")
+
+    # Serve a story pre-generated off-peak when one matches the request
+    if authenticated and story_type == "original":
+        try:
+            pregenerated = claim_inbox_story(repo, user_id, story_type, length, preferred_language, user_settings)
+            if pregenerated:
+                return jsonify({
+                    "success": True,
+                    "story": pregenerated['story_text'],
+                    "language": pregenerated['language']
+                })
+        except Exception:
+            pass  # Fall back to generating a fresh story
 
-    # Translate if needed
-    if result.get('success') and preferred_language != "English":
-        translated = translate_story(result['story'], preferred_language)
-        result['story'] = translated
-        result['language'] = preferred_language
-    else:
-        result['language'] = "English"
+    # Near-duplicate original_about requests get an existing highly rated story
+    if SIMILARITY_ENABLED and story_type == "original_about":
+        try:
+            match = similar_stories.lookup(repo, user_id if authenticated else None, modifications,
+                                           build_personalization(story_type, user_settings), length, preferred_language)
+            if match:
+                return jsonify({
+                    "success": True,
+                    "story": format_stored_story(match['title'], match['story_text']),
+                    "language": match['language'] or preferred_language,
+                    "similarity": round(match['similarity'], 2)
+                })
+        except Exception as e:
+            print(f"Similarity lookup error: {e}")
+
+    # Shed load early instead of letting requests pile up behind a slow upstream
+    decision = admission.admit(authenticated)
+    if decision == REJECT:
+        retry_after = admission.retry_after()
+        return jsonify({
+            "success": False,
+            "error": "The story generator is busy right now. Please try again shortly.",
+            "retry_after": retry_after
+        }), 503, {"Retry-After": str(retry_after)}
+
+    try:
+        reduced = False
+        if decision == DEGRADE:
+            # Prefer a stored story: no upstream call at all (only for types that
+            # don't depend on per-request modifications; any saved classic will
+            # do for "surprise", but not for a specific tale)
+            if authenticated and story_type in ("original", "classic") and classic_tale_id in (None, "", "surprise"):
+                try:
+                    stored = repo.find_stored_story(user_id, story_type, preferred_language)
+                except Exception:
+                    stored = None
+                if stored:
+                    admission.count('degraded_stored_story')
+                    return jsonify({
+                        "success": True,
+                        "story": format_stored_story(stored['title'], stored['story_text']),
+                        "language": stored['language'] or "English",
+                        "degraded": "stored_story"
+                    })
+
+            # Otherwise generate a shorter story and skip translation
+            if length > DEGRADED_MAX_LENGTH:
+                admission.count('degraded_shorter_length')
+                length = DEGRADED_MAX_LENGTH
+                reduced = True
+            if preferred_language != "English":
+                admission.count('degraded_skipped_translation')
+                preferred_language = "English"
+                reduced = True
+            if not reduced:
+                admission.count('accepted')  # Already short and in English
+
+        # Generate story in English
+        started = time.monotonic()
+        result = generate_story(story_type, length, modifications, user_settings, classic_tale_id)
+        admission.record_latency(time.monotonic() - started)
+
+        # Translate if needed
+        if result.get('success') and preferred_language != "English":
+            translated = translate_story(result['story'], preferred_language)
+            result['story'] = translated
+            result['language'] = preferred_language
+        else:
+            result['language'] = "English"
+
+        if reduced:
+            result['degraded'] = "reduced"
+        return jsonify(result)
+    finally:
+        admission.release()
 
-    return jsonify(result)
+
+@app.route('/similarity-stats', methods=['GET'])
+def similarity_stats():
+    """Near-duplicate index hit rate and similarity metrics for this worker."""
+    return jsonify({"success": True, **similar_stories.stats()})
+
+
+@app.route('/inbox-stats', methods=['GET'])
+def inbox_stats():
+    """Pre-generated stories served vs. expired unserved, across all workers."""
+    try:
+        return jsonify({"success": True, **get_inbox_stats(repo)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+
+@app.route('/admission-stats', methods=['GET'])
+def admission_stats():
+    """Current load and admission/degradation counters for this worker."""
+    return jsonify({"success": True, **admission.stats()})
 
 
 # =============================================================================
@@ -200,27 +287,13 @@ def register():
         return jsonify({"success": False, "error": "Password must be at least 6 characters"})
 
     try:
-        conn = get_db()
-
-        # Check if email already exists
-        existing = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
-        if existing:
-            conn.close()
-            return jsonify({"success": False, "error": "Email already registered"})
-
-        # Create user with hashed password and token
+        # Create user with hashed password and token (None if the email already exists)
         password_hash = hash_password(password)
         token = generate_token()
 
-        conn.execute('''
-            INSERT INTO users (email, password_hash, display_name, token)
-            VALUES (?, ?, ?, ?)
-        ''', (email, password_hash, display_name or email.split('@')[0], token))
-        conn.commit()
-
-        # Get the new user's ID
-        user = conn.execute('SELECT id, display_name FROM users WHERE email = ?', (email,)).fetchone()
-        conn.close()
+        user = repo.create_user(email, password_hash, display_name or email.split('@')[0], token)
+        if not user:
+            return jsonify({"success": False, "error": "Email already registered"})
 
         return jsonify({
             "success": True,
@@ -245,18 +318,14 @@ def login():
         return jsonify({"success": False, "error": "Email and password required"})
 
     try:
-        conn = get_db()
-        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        user = repo.get_user_by_email(email)
 
         if not user or not verify_password(password, user['password_hash']):
-            conn.close()
             return jsonify({"success": False, "error": "Invalid email or password"})
 
         # Generate new token on login
         token = generate_token()
-        conn.execute('UPDATE users SET token = ? WHERE id = ?', (token, user['id']))
-        conn.commit()
-        conn.close()
+        repo.set_token(user['id'], token)
 
         return jsonify({
             "success": True,
@@ -288,29 +357,29 @@ def save_story():
         return jsonify({"success": False, "error": "Missing required fields"})
 
     try:
-        conn = get_db()
-
         # Verify token
-        user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-        if not user:
-            conn.close()
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
-        conn.execute('''
-            INSERT INTO saved_stories (user_id, title, story_text, story_type, language, length_minutes, modifications, rating)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            title,
-            story_text,
-            data.get('story_type'),
-            data.get('language'),
-            data.get('length_minutes'),
-            data.get('modifications'),
-            rating
-        ))
-        conn.commit()
-        conn.close()
+        story_id = repo.save_story(user_id, {
+            "title": title,
+            "story_text": story_text,
+            "story_type": data.get('story_type'),
+            "language": data.get('language'),
+            "length_minutes": data.get('length_minutes'),
+            "modifications": data.get('modifications'),
+            "rating": rating
+        })
+
+        # Highly rated original_about stories can be reused for other users' similar
+        # requests if the owner shares stories. The story is already saved, so
+        # indexing errors must not fail the request.
+        if SIMILARITY_ENABLED and data.get('story_type') == "original_about":
+            try:
+                similar_stories.index_story(repo, repo.get_story(user_id, story_id), replace=False)
+            except Exception as e:
+                print(f"Similarity index error: {e}")
+
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -325,23 +394,96 @@ def my_stories():
         return jsonify({"success": False, "error": "Authentication required"})
 
     try:
-        conn = get_db()
+        # Verify token
+        if not repo.verify_token(user_id, token):
+            return jsonify({"success": False, "error": "Invalid authentication"})
+
+        stories_list = repo.list_stories(user_id)
+        return jsonify({"success": True, "stories": stories_list})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+EXPORT_CHUNK_BYTES = 64 * 1024  # Rows are buffered into chunks of about this size
+
+
+def _ndjson_chunks(rows):
+    """Encode rows as NDJSON, yielding ~EXPORT_CHUNK_BYTES chunks."""
+    buffer = []
+    size = 0
+    for row in rows:
+        line = (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _gzip_chunks(chunks):
+    """Gzip a stream of byte chunks on the fly."""
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@app.route('/export-stories', methods=['GET'])
+def export_stories():
+    """
+    Stream all saved stories for a user as NDJSON (one story per line).
+    Pass gzip=1 to get a gzip-compressed file. Requires authentication.
+    """
+    user_id = request.args.get('user_id')
+    token = request.args.get('token')
+
+    if not user_id or not token:
+        return jsonify({"success": False, "error": "Authentication required"})
+
+    try:
+        # Verify token
+        if not repo.verify_token(user_id, token):
+            return jsonify({"success": False, "error": "Invalid authentication"})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+    chunks = _ndjson_chunks(repo.iter_stories(user_id))
+    if request.args.get('gzip') in ('1', 'true'):
+        return Response(_gzip_chunks(chunks), mimetype='application/gzip',
+                        headers={"Content-Disposition": "attachment; filename=stories.ndjson.gz"})
+    return Response(chunks, mimetype='application/x-ndjson',
+                    headers={"Content-Disposition": "attachment; filename=stories.ndjson"})
+
+
+@app.route('/import-stories', methods=['POST'])
+def import_stories():
+    """
+    Import stories from an NDJSON request body (as produced by /export-stories).
+    The body is parsed as a stream; send it gzip-compressed with
+    Content-Encoding: gzip or ?gzip=1. Stories the user already has (same
+    title and text) are skipped. Requires authentication via query args.
+    """
+    user_id = request.args.get('user_id')
+    token = request.args.get('token')
 
+    if not user_id or not token:
+        return jsonify({"success": False, "error": "Authentication required"})
+
+    try:
         # Verify token
-        user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-        if not user:
-            conn.close()
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
-        stories = conn.execute(
-            'SELECT * FROM saved_stories WHERE user_id = ? ORDER BY saved_at DESC',
-            (user_id,)
-        ).fetchall()
-        conn.close()
+        stream = request.stream
+        if request.headers.get('Content-Encoding') == 'gzip' or request.args.get('gzip') in ('1', 'true'):
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
 
-        # Convert rows to dictionaries
-        stories_list = [dict(story) for story in stories]
-        return jsonify({"success": True, "stories": stories_list})
+        counts = repo.import_stories(user_id, stream)
+        return jsonify({"success": True, **counts})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -359,16 +501,11 @@ def get_settings():
         return jsonify({"success": False, "error": "Authentication required"})
 
     try:
-        conn = get_db()
-
         # Verify token
-        user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-        if not user:
-            conn.close()
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
-        settings = conn.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
-        conn.close()
+        settings = repo.get_settings(user_id)
 
         if settings:
             return jsonify({
@@ -378,7 +515,8 @@ def get_settings():
                     "tone_custom": settings['tone_custom'],
                     "favorite_topics": settings['favorite_topics'],
                     "child_age": settings['child_age'],
-                    "preferred_language": settings['preferred_language'] or 'English'
+                    "preferred_language": settings['preferred_language'] or 'English',
+                    "share_stories": shares_stories(settings)
                 }
             })
         else:
@@ -390,7 +528,8 @@ def get_settings():
                     "tone_custom": None,
                     "favorite_topics": None,
                     "child_age": 6,
-                    "preferred_language": "English"
+                    "preferred_language": "English",
+                    "share_stories": False
                 }
             })
 
@@ -410,28 +549,25 @@ def save_settings():
         return jsonify({"success": False, "error": "Authentication required"})
 
     try:
-        conn = get_db()
-
         # Verify token
-        user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-        if not user:
-            conn.close()
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
-        # Use INSERT OR REPLACE to handle both new and existing settings
-        conn.execute('''
-            INSERT OR REPLACE INTO user_settings (user_id, tones, tone_custom, favorite_topics, child_age, preferred_language)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            data.get('tones'),
-            data.get('tone_custom'),
-            data.get('favorite_topics'),
-            data.get('child_age', 6),
-            data.get('preferred_language', 'English')
-        ))
-        conn.commit()
-        conn.close()
+        repo.save_settings(user_id, {
+            "tones": data.get('tones'),
+            "tone_custom": data.get('tone_custom'),
+            "favorite_topics": data.get('favorite_topics'),
+            "child_age": data.get('child_age', 6),
+            "preferred_language": data.get('preferred_language', 'English'),
+            "share_stories": 1 if data.get('share_stories') else 0
+        })
+
+        # Stories must stop being reused for other users as soon as sharing is off
+        if not data.get('share_stories'):
+            try:
+                similar_stories.remove_user(repo, user_id)
+            except Exception as e:
+                print(f"Similarity index error: {e}")
 
         return jsonify({"success": True})
 
@@ -439,6 +575,14 @@ def save_settings():
         return jsonify({"success": False, "error": str(e)})
 
 
+def unindex_similar_story(user_id, story_id):
+    """Remove a saved story from the near-duplicate index (even if the feature is off now)."""
+    try:
+        similar_stories.remove(repo, user_id, story_id)
+    except Exception as e:
+        print(f"Similarity index error: {e}")
+
+
 @app.route('/update-rating', methods=['POST'])
 def update_rating():
     """Update the rating of a saved story. Requires authentication."""
@@ -453,20 +597,26 @@ def update_rating():
         return jsonify({"success": False, "error": "Missing required fields"})
 
     try:
-        conn = get_db()
-
-        # Verify token and that story belongs to user
-        user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
-        if not user:
-            conn.close()
+        # Verify token; the update only touches the story if it belongs to the user
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
-        conn.execute(
-            'UPDATE saved_stories SET rating = ? WHERE id = ? AND user_id = ?',
-            (new_rating, story_id, user_id)
-        )
-        conn.commit()
-        conn.close()
+        repo.update_rating(user_id, story_id, new_rating)
+
+        # Up-rated stories become reusable for similar requests; down-rated ones must no longer be
+        if SIMILARITY_ENABLED:
+            try:
+                story = repo.get_story(user_id, story_id)
+                if story:
+                    similar_stories.index_story(repo, story)
+            except Exception as e:
+                print(f"Similarity index error: {e}")
+        else:
+            try:
+                if int(new_rating) < MIN_RATING:
+                    unindex_similar_story(user_id, story_id)
+            except (TypeError, ValueError):
+                pass
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -483,30 +633,16 @@ def delete_story():
         if not story_id or not user_id or not token:
             return jsonify({"success": False, "error": "Missing required data"})
 
-        conn = get_db()
-        
         # Verify user authentication
-        user = conn.execute(
-            'SELECT id FROM users WHERE id = ? AND token = ?',
-            (user_id, token)
-        ).fetchone()
-        
-        if not user:
-            conn.close()
+        if not repo.verify_token(user_id, token):
             return jsonify({"success": False, "error": "Invalid authentication"})
 
         # Delete the story (only if it belongs to the user)
-        result = conn.execute(
-            'DELETE FROM saved_stories WHERE id = ? AND user_id = ?',
-            (story_id, user_id)
-        )
-        
-        if result.rowcount == 0:
-            conn.close()
+        if not repo.delete_story(user_id, story_id):
             return jsonify({"success": False, "error": "Story not found or not authorized"})
-        
-        conn.commit()
-        conn.close()
+
+        # Deleted stories must no longer be reused for similar requests
+        unindex_similar_story(user_id, story_id)
         return jsonify({"success": True, "message": "Story deleted successfully"})
         
     except Exception as e:
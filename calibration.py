@@ -0,0 +1,177 @@
+"""
+Word-count and token-budget calibration for Bedtime Story Generator
+
+Records how many words each story asked for vs. how many the model actually
+wrote (plus Groq token usage), bucketed by (model, story_type, length). The
+learned factors feed back into the prompt's word target and the per-request
+max_tokens budget.
+
+Records are stored through the repository (see db.py). Run
+`python calibration.py` for an offline report; it reads the backend selected
+by STORAGE_BACKEND.
+"""
+
+from llm_config import (
+    MAX_TOKENS, TOKENS_PER_WORD, CALIBRATION_MIN_SAMPLES, CALIBRATION_WINDOW,
+    WORD_FACTOR_RANGE, estimate_words_from_minutes, estimate_max_tokens
+)
+
+
+def count_story_words(story_text: str) -> int:
+    """Count words in the story body, skipping the title line."""
+    if not story_text:
+        return 0
+    lines = story_text.strip().split('\n', 1)
+    body = lines[1] if len(lines) > 1 else lines[0]
+    return len(body.split())
+
+
+def record_generation(repo, model, story_type, length_minutes, target_words,
+                      prompted_words, story_text, max_tokens, usage=None, finish_reason=None):
+    """
+    Store one completed generation for calibration.
+
+    Args:
+        repo: Storage repository
+        target_words: Words the user's reading time calls for
+        prompted_words: Words actually requested in the prompt (after correction)
+        story_text: The generated story (English, before translation)
+        max_tokens: Completion budget sent with the request
+        usage: Groq usage object (prompt_tokens / completion_tokens), if any
+        finish_reason: "stop", "length", ... from the Groq response
+    """
+    repo.record_generation({
+        "model": model,
+        "story_type": story_type,
+        "length_minutes": length_minutes,
+        "target_words": target_words,
+        "prompted_words": prompted_words,
+        "actual_words": count_story_words(story_text),
+        "max_tokens": max_tokens,
+        "prompt_tokens": getattr(usage, 'prompt_tokens', None),
+        "completion_tokens": getattr(usage, 'completion_tokens', None),
+        "finish_reason": finish_reason
+    })
+
+
+def get_calibration(repo, model, story_type, length_minutes):
+    """
+    Learn correction factors for a (model, story_type, length) bucket.
+
+    A sparse bucket falls back to every length of the same model and story
+    type: the model's over- or undershoot and its tokens per word hardly
+    depend on length, so one well-calibrated length covers the others.
+
+    Truncated completions (finish_reason "length") are kept: their word count
+    is a lower bound on what the model would have written, so an overshooting
+    model still pulls word_factor down until its stories fit the budget.
+
+    Returns:
+        dict with word_factor (multiply the target word count by this in the
+        prompt), tokens_per_word, the number of samples used and their
+        source: "bucket", "pooled", or "default" (1.0, TOKENS_PER_WORD) when
+        fewer than CALIBRATION_MIN_SAMPLES are available either way.
+    """
+    rows = repo.generation_samples(model, story_type, length_minutes, CALIBRATION_WINDOW)
+    source = "bucket"
+    if len(rows) < CALIBRATION_MIN_SAMPLES:
+        rows = repo.generation_samples(model, story_type, None, CALIBRATION_WINDOW)
+        source = "pooled"
+
+    calibration = {"word_factor": 1.0, "tokens_per_word": TOKENS_PER_WORD, "samples": len(rows), "source": source}
+    if len(rows) < CALIBRATION_MIN_SAMPLES:
+        calibration['source'] = "default"
+        return calibration
+
+    prompted = sum(row['prompted_words'] for row in rows)
+    actual = sum(row['actual_words'] for row in rows)
+
+    # The model writes actual/prompted words per word asked; invert it
+    low, high = WORD_FACTOR_RANGE
+    calibration['word_factor'] = max(low, min(high, prompted / actual))
+
+    with_usage = [row for row in rows if row['completion_tokens']]
+    if with_usage:
+        tokens = sum(row['completion_tokens'] for row in with_usage)
+        words = sum(row['actual_words'] for row in with_usage)
+        calibration['tokens_per_word'] = tokens / words
+
+    return calibration
+
+
+def token_budget(calibration, target_words) -> int:
+    """
+    max_tokens for a request. Until anything is learned the model's real
+    output length is unknown, so it gets the full MAX_TOKENS rather than a
+    guess that would cut off an overshooting model.
+    """
+    if calibration['source'] == "default":
+        return MAX_TOKENS
+    # After correction the model is expected to write about target_words
+    return estimate_max_tokens(target_words, calibration['tokens_per_word'])
+
+
+def build_report(repo):
+    """
+    Summarize calibration per bucket and the token budget saved vs. MAX_TOKENS.
+
+    reserved_tokens_saved is what the recorded requests actually reserved
+    below the flat MAX_TOKENS; max_tokens is the budget the next request
+    in the bucket would get.
+
+    Returns:
+        list of dicts, one per (model, story_type, length_minutes) bucket
+    """
+    buckets = repo.generation_buckets(MAX_TOKENS)
+
+    report = []
+    for bucket in buckets:
+        calibration = get_calibration(repo, bucket['model'], bucket['story_type'], bucket['length_minutes'])
+        target_words = estimate_words_from_minutes(bucket['length_minutes'])
+        budget = token_budget(calibration, target_words)
+        report.append({
+            "model": bucket['model'],
+            "story_type": bucket['story_type'],
+            "length_minutes": bucket['length_minutes'],
+            "generations": bucket['generations'],
+            "truncated": bucket['truncated'],
+            "avg_target_words": round(bucket['avg_target'] or 0),
+            "avg_actual_words": round(bucket['avg_actual'] or 0),
+            "target_words": target_words,
+            "word_factor": round(calibration['word_factor'], 3),
+            "source": calibration['source'],
+            "tokens_per_word": round(calibration['tokens_per_word'], 3),
+            "max_tokens": budget,
+            "reserved_tokens_saved": bucket['tokens_saved'] or 0,
+            "avg_completion_tokens": round(bucket['avg_completion'] or 0),
+        })
+    return report
+
+
+def print_report(report):
+    """Print the calibration report as a plain table."""
+    if not report:
+        print("No generations recorded yet.")
+        return
+
+    header = f"{'model':<28} {'type':<15} {'min':>4} {'gens':>5} {'trunc':>5} {'target':>7} {'actual':>7} {'factor':>7} {'source':>8} {'tok/w':>6} {'budget':>7} {'saved':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in report:
+        print(f"{row['model']:<28} {str(row['story_type']):<15} {row['length_minutes']:>4} {row['generations']:>5} "
+              f"{row['truncated']:>5} {row['avg_target_words']:>7} {row['avg_actual_words']:>7} "
+              f"{row['word_factor']:>7} {row['source']:>8} {row['tokens_per_word']:>6} {row['max_tokens']:>7} {row['reserved_tokens_saved']:>9}")
+
+    total_generations = sum(row['generations'] for row in report)
+    total_saved = sum(row['reserved_tokens_saved'] for row in report)
+    print()
+    print(f"{total_generations} generations; {total_saved} reserved completion tokens saved "
+          f"vs. a flat MAX_TOKENS={MAX_TOKENS}")
+
+
+if __name__ == '__main__':
+    from db import get_repository
+
+    repo = get_repository()
+    repo.init_schema()
+    print_report(build_report(repo))
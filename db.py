@@ -0,0 +1,1031 @@
+"""
+Storage layer for Bedtime Story Generator
+
+All database access goes through a repository (users, sessions, settings,
+stories, inbox, calibration stats, similarity index) so routes and batch jobs
+never see a database connection. Two backends:
+
+- SQLiteRepository: everything in one file (stories.db), the original layout.
+- ShardedSQLiteRepository: a small global directory file for auth, settings
+  and the similarity index, a separate stats file for calibration records
+  (written on every generation), plus story data (saved_stories, story_inbox)
+  spread over several SQLite files by a hash of user_id. Each file has its
+  own writer lock, so story and stats writes never block logins.
+
+Pick a backend with environment variables:
+
+    STORAGE_BACKEND=sqlite   DATABASE=stories.db            (default)
+    STORAGE_BACKEND=sharded  SHARD_DIR=shards SHARD_COUNT=4
+
+Split an existing single-file database into shards with:
+
+    python db.py split stories.db shards 4
+"""
+
+import abc
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+
+DATABASE = os.environ.get('DATABASE', 'stories.db')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+SHARD_DIR = os.environ.get('SHARD_DIR', 'shards')
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 4))
+DIRECTORY_FILE = 'directory.db'
+STATS_FILE = 'stats.db'
+SHARD_FILE = 'stories-{}.db'
+
+STORY_COLUMNS = ('title', 'story_text', 'story_type', 'language', 'length_minutes', 'modifications', 'rating')
+EXPORT_COLUMNS = ('id',) + STORY_COLUMNS + ('saved_at',)
+IMPORT_BATCH_SIZE = 500
+SETTINGS_COLUMNS = ('tones', 'tone_custom', 'favorite_topics', 'child_age', 'preferred_language', 'share_stories')
+GENERATION_COLUMNS = ('model', 'story_type', 'length_minutes', 'target_words', 'prompted_words', 'actual_words',
+                      'max_tokens', 'prompt_tokens', 'completion_tokens', 'finish_reason')
+
+
+def connect(path):
+    """Open a SQLite connection that returns rows as dictionaries."""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_global_schema(conn):
+    """Create the auth, settings and similarity index tables."""
+    # Users table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            display_name TEXT,
+            token TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # User settings table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            tones TEXT,
+            tone_custom TEXT,
+            favorite_topics TEXT,
+            child_age INTEGER DEFAULT 6,
+            preferred_language TEXT DEFAULT 'English',
+            share_stories INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Migration: Add preferred_language column if updating from old schema
+    try:
+        conn.execute("ALTER TABLE user_settings ADD COLUMN preferred_language TEXT DEFAULT 'English'")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Migration: Add share_stories column (opt-in to reuse of saved stories for other users, see similarity.py)
+    try:
+        conn.execute('ALTER TABLE user_settings ADD COLUMN share_stories INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # MinHash index of highly rated original_about stories (see similarity.py).
+    # Migration: early versions copied story text instead of pointing at the
+    # saved story. The index is derived data, so drop and rebuild it.
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(similarity_index)')]
+    if columns and 'story_id' not in columns:
+        conn.execute('DROP TABLE similarity_index')
+
+    # user_id + story_id point at the saved story (and so at its shard)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS similarity_index (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            story_id INTEGER NOT NULL,
+            normalized_text TEXT NOT NULL,
+            signature TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_similarity_index_story
+        ON similarity_index (user_id, story_id)
+    ''')
+
+
+def init_stats_schema(conn):
+    """Create the generation_stats table (word counts and token usage, see calibration.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model TEXT NOT NULL,
+            story_type TEXT,
+            length_minutes INTEGER,
+            target_words INTEGER,
+            prompted_words INTEGER,
+            actual_words INTEGER,
+            max_tokens INTEGER,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            finish_reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generation_stats_bucket
+        ON generation_stats (model, story_type, length_minutes)
+    ''')
+
+
+def init_story_schema(conn):
+    """Create the per-user story tables."""
+    # Saved stories table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS saved_stories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            story_text TEXT NOT NULL,
+            story_type TEXT,
+            language TEXT,
+            length_minutes INTEGER,
+            modifications TEXT,
+            rating INTEGER CHECK(rating >= 1 AND rating <= 5),
+            saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Migration: Add user_id column if updating from old schema
+    try:
+        conn.execute('ALTER TABLE saved_stories ADD COLUMN user_id INTEGER')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Pre-generated stories waiting for each user (filled by inbox.py off-peak)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS story_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            story_type TEXT NOT NULL,
+            length_minutes INTEGER NOT NULL,
+            language TEXT NOT NULL,
+            settings_fingerprint TEXT NOT NULL,
+            story_text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            served_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_story_inbox_user
+        ON story_inbox (user_id, story_type, length_minutes, language)
+    ''')
+
+    # When each user last asked for a story, so pre-generation also covers
+    # users who generate every night but never save
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            last_generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def shard_for(user_id, shard_count: int) -> int:
+    """
+    Map a user to a shard. Uses a stable hash (not Python's hash()) so every
+    process agrees, and so non-integer ids (e.g. UUIDs) spread evenly too.
+    """
+    digest = hashlib.md5(str(user_id).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count
+
+
+class Repository(abc.ABC):
+    """Interface every storage backend implements. Callers never get a connection."""
+
+    @abc.abstractmethod
+    def init_schema(self):
+        """Create or migrate every table."""
+
+    # Users and sessions
+    @abc.abstractmethod
+    def create_user(self, email, password_hash, display_name, token):
+        """Insert a new user. Returns the new user, or None if the email is taken."""
+
+    @abc.abstractmethod
+    def get_user_by_email(self, email):
+        """The user row for an email, or None."""
+
+    @abc.abstractmethod
+    def set_token(self, user_id, token):
+        """Store a new session token."""
+
+    @abc.abstractmethod
+    def verify_token(self, user_id, token) -> bool:
+        """Whether the token is the user's current session token."""
+
+    # Settings
+    @abc.abstractmethod
+    def get_settings(self, user_id):
+        """The user's settings row, or None."""
+
+    @abc.abstractmethod
+    def save_settings(self, user_id, settings: dict):
+        """Insert or replace the user's settings."""
+
+    # Stories
+    @abc.abstractmethod
+    def save_story(self, user_id, story: dict):
+        """Save a story. Returns its id."""
+
+    @abc.abstractmethod
+    def get_story(self, user_id, story_id):
+        """One of the user's saved stories, or None."""
+
+    @abc.abstractmethod
+    def list_stories(self, user_id):
+        """The user's saved stories, newest first."""
+
+    @abc.abstractmethod
+    def update_rating(self, user_id, story_id, rating):
+        """Change the rating of one of the user's stories."""
+
+    @abc.abstractmethod
+    def delete_story(self, user_id, story_id) -> bool:
+        """Delete one of the user's stories. Returns False if nothing was deleted."""
+
+    @abc.abstractmethod
+    def find_stored_story(self, user_id, story_type, language):
+        """One of the user's highly rated stories of this type, or None."""
+
+    @abc.abstractmethod
+    def iter_stories(self, user_id):
+        """Yield the user's saved stories one at a time, oldest first."""
+
+    @abc.abstractmethod
+    def iter_rated_stories(self, story_type, min_rating):
+        """Yield every user's stories of this type rated at least min_rating (without the text), by user."""
+
+    @abc.abstractmethod
+    def import_stories(self, user_id, lines, batch_size=IMPORT_BATCH_SIZE) -> dict:
+        """Insert stories from NDJSON lines. Returns imported/duplicates/invalid counts."""
+
+    # Story inbox (see inbox.py)
+    @abc.abstractmethod
+    def claim_inbox_story(self, user_id, story_type, length_minutes, language, fingerprint):
+        """Mark a matching, unexpired inbox story served and return it, or None."""
+
+    @abc.abstractmethod
+    def add_inbox_story(self, user_id, story_type, length_minutes, language, fingerprint, story_text, ttl_hours):
+        """Store a pre-generated story in the user's inbox."""
+
+    @abc.abstractmethod
+    def count_pending_inbox(self, user_id, story_type, length_minutes, language, fingerprint) -> int:
+        """Unserved, unexpired inbox stories matching a request."""
+
+    @abc.abstractmethod
+    def purge_inbox(self, retention_days):
+        """Delete inbox items created more than retention_days ago."""
+
+    @abc.abstractmethod
+    def inbox_stats(self, days):
+        """Inbox items generated, served, expired unserved and still pending over the last `days` days."""
+
+    @abc.abstractmethod
+    def record_activity(self, user_id):
+        """Note that the user just asked for a story."""
+
+    @abc.abstractmethod
+    def active_user_ids(self, days):
+        """Users who generated, saved or were served a story in the last `days` days."""
+
+    @abc.abstractmethod
+    def saved_lengths(self, user_id, story_type):
+        """Lengths (minutes) of the user's saved stories of this type."""
+
+    # Calibration stats (see calibration.py)
+    @abc.abstractmethod
+    def record_generation(self, stats: dict):
+        """Store one generation's GENERATION_COLUMNS."""
+
+    @abc.abstractmethod
+    def generation_samples(self, model, story_type, length_minutes, limit):
+        """The most recent generations with word counts for a bucket (any length if None), newest first."""
+
+    @abc.abstractmethod
+    def generation_buckets(self, flat_max_tokens):
+        """Per (model, story_type, length_minutes) totals for the calibration report."""
+
+    # Similarity index (see similarity.py)
+    @abc.abstractmethod
+    def add_similarity_entry(self, scope, user_id, story_id, normalized_text, signature):
+        """Index a saved story. Returns the entry id."""
+
+    @abc.abstractmethod
+    def similarity_entries_since(self, last_id):
+        """Entries with an id above last_id, in id order."""
+
+    @abc.abstractmethod
+    def remove_similarity_entries(self, user_id, story_id):
+        """Delete a story's entries. Returns the deleted entry ids."""
+
+    @abc.abstractmethod
+    def remove_user_similarity_entries(self, user_id):
+        """Delete every entry for the user's stories. Returns the deleted entry ids."""
+
+    @abc.abstractmethod
+    def delete_similarity_entry(self, entry_id):
+        """Delete one entry by id."""
+
+    @abc.abstractmethod
+    def clear_similarity_index(self):
+        """Delete every entry, before a rebuild."""
+
+
+def story_key(title, story_text):
+    """Dedupe key for imports: title plus a hash of the story text."""
+    return (title, hashlib.sha1((story_text or '').encode('utf-8')).hexdigest())
+
+
+def parse_story_line(line):
+    """
+    Parse one NDJSON line into a story dict for saved_stories.
+
+    Returns:
+        dict of STORY_COLUMNS (+ saved_at), or None if the line is blank or invalid
+    """
+    try:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            return None
+        data = json.loads(line)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict) or not data.get('story_text'):
+        return None
+
+    story = {column: data.get(column) for column in STORY_COLUMNS}
+    # Ratings outside 1-5 would fail the CHECK constraint and abort the whole batch
+    if story['rating'] is not None and story['rating'] not in (1, 2, 3, 4, 5):
+        story['rating'] = None
+    story['saved_at'] = data.get('saved_at')
+    return story
+
+
+class SQLiteRepository(Repository):
+    """Everything in a single SQLite file."""
+
+    def __init__(self, path=DATABASE):
+        self.path = path
+        self.stats_path = path
+        self.story_paths = [path]
+
+    def init_schema(self):
+        for path, init in [(self.path, init_global_schema), (self.stats_path, init_stats_schema)] + \
+                          [(path, init_story_schema) for path in self.story_paths]:
+            conn = connect(path)
+            init(conn)
+            conn.commit()
+            conn.close()
+
+    def _directory(self):
+        """Connection to the database holding users, settings and the similarity index."""
+        return connect(self.path)
+
+    def _stats(self):
+        """Connection to the database holding calibration stats."""
+        return connect(self.stats_path)
+
+    def _story_path(self, user_id):
+        """Path of the database holding this user's stories."""
+        return self.story_paths[0]
+
+    def _stories(self, user_id):
+        """Connection to the database holding this user's stories."""
+        return connect(self._story_path(user_id))
+
+    # Users and sessions
+
+    def create_user(self, email, password_hash, display_name, token):
+        conn = self._directory()
+        try:
+            existing = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+            if existing:
+                return None
+            cursor = conn.execute('''
+                INSERT INTO users (email, password_hash, display_name, token)
+                VALUES (?, ?, ?, ?)
+            ''', (email, password_hash, display_name, token))
+            conn.commit()
+            user = conn.execute('SELECT id, display_name FROM users WHERE id = ?', (cursor.lastrowid,)).fetchone()
+            return dict(user)
+        finally:
+            conn.close()
+
+    def get_user_by_email(self, email):
+        conn = self._directory()
+        try:
+            user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+            return dict(user) if user else None
+        finally:
+            conn.close()
+
+    def set_token(self, user_id, token):
+        conn = self._directory()
+        try:
+            conn.execute('UPDATE users SET token = ? WHERE id = ?', (token, user_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def verify_token(self, user_id, token) -> bool:
+        if not user_id or not token:
+            return False
+        conn = self._directory()
+        try:
+            user = conn.execute('SELECT id FROM users WHERE id = ? AND token = ?', (user_id, token)).fetchone()
+            return user is not None
+        finally:
+            conn.close()
+
+    # Settings
+
+    def get_settings(self, user_id):
+        conn = self._directory()
+        try:
+            settings = conn.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
+            return dict(settings) if settings else None
+        finally:
+            conn.close()
+
+    def save_settings(self, user_id, settings: dict):
+        conn = self._directory()
+        try:
+            # INSERT OR REPLACE handles both new and existing settings
+            conn.execute(f'''
+                INSERT OR REPLACE INTO user_settings (user_id, {', '.join(SETTINGS_COLUMNS)})
+                VALUES (?, {', '.join('?' * len(SETTINGS_COLUMNS))})
+            ''', (user_id, *(settings.get(column) for column in SETTINGS_COLUMNS)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Stories
+
+    def save_story(self, user_id, story: dict):
+        """Save a story. Returns its id (unique per user)."""
+        conn = self._stories(user_id)
+        try:
+            cursor = conn.execute('''
+                INSERT INTO saved_stories (user_id, title, story_text, story_type, language, length_minutes, modifications, rating)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, *(story.get(column) for column in STORY_COLUMNS)))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def get_story(self, user_id, story_id):
+        conn = self._stories(user_id)
+        try:
+            story = conn.execute(
+                'SELECT * FROM saved_stories WHERE id = ? AND user_id = ?', (story_id, user_id)
+            ).fetchone()
+            return dict(story) if story else None
+        finally:
+            conn.close()
+
+    def list_stories(self, user_id):
+        conn = self._stories(user_id)
+        try:
+            stories = conn.execute(
+                'SELECT * FROM saved_stories WHERE user_id = ? ORDER BY saved_at DESC',
+                (user_id,)
+            ).fetchall()
+            return [dict(story) for story in stories]
+        finally:
+            conn.close()
+
+    def update_rating(self, user_id, story_id, rating):
+        conn = self._stories(user_id)
+        try:
+            conn.execute(
+                'UPDATE saved_stories SET rating = ? WHERE id = ? AND user_id = ?',
+                (rating, story_id, user_id)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete_story(self, user_id, story_id) -> bool:
+        """Delete a story if it belongs to the user. Returns False if nothing was deleted."""
+        conn = self._stories(user_id)
+        try:
+            result = conn.execute(
+                'DELETE FROM saved_stories WHERE id = ? AND user_id = ?',
+                (story_id, user_id)
+            )
+            conn.commit()
+            return result.rowcount > 0
+        finally:
+            conn.close()
+
+    def find_stored_story(self, user_id, story_type, language):
+        """One of the user's highly rated saved stories of this type, preferring the language."""
+        conn = self._stories(user_id)
+        try:
+            story = conn.execute('''
+                SELECT title, story_text, language FROM saved_stories
+                WHERE user_id = ? AND story_type = ? AND rating >= 4
+                ORDER BY (language = ?) DESC, RANDOM()
+                LIMIT 1
+            ''', (user_id, story_type, language)).fetchone()
+            return dict(story) if story else None
+        finally:
+            conn.close()
+
+    def iter_stories(self, user_id):
+        """
+        Yield the user's saved stories one row at a time, straight from the
+        cursor, so exports use constant memory regardless of library size.
+        """
+        conn = self._stories(user_id)
+        try:
+            cursor = conn.execute(
+                f"SELECT {', '.join(EXPORT_COLUMNS)} FROM saved_stories WHERE user_id = ? ORDER BY saved_at",
+                (user_id,)
+            )
+            for story in cursor:
+                yield dict(story)
+        finally:
+            conn.close()
+
+    def iter_rated_stories(self, story_type, min_rating):
+        for path in self.story_paths:
+            conn = connect(path)
+            try:
+                cursor = conn.execute('''
+                    SELECT id, user_id, story_type, language, length_minutes, modifications, rating
+                    FROM saved_stories
+                    WHERE story_type = ? AND rating >= ? AND user_id IS NOT NULL
+                    ORDER BY user_id, id
+                ''', (story_type, min_rating))
+                for story in cursor:
+                    yield dict(story)
+            finally:
+                conn.close()
+
+    def import_stories(self, user_id, lines, batch_size=IMPORT_BATCH_SIZE) -> dict:
+        """
+        Insert stories from NDJSON lines in batched transactions, skipping any
+        the user already has with the same title and text.
+
+        Returns:
+            dict with imported, duplicates and invalid line counts
+        """
+        conn = self._stories(user_id)
+        counts = {"imported": 0, "duplicates": 0, "invalid": 0}
+        try:
+            # Only titles and text hashes are kept in memory, not the stories
+            seen = {story_key(row['title'], row['story_text']) for row in conn.execute(
+                'SELECT title, story_text FROM saved_stories WHERE user_id = ?', (user_id,)
+            )}
+
+            insert = '''
+                INSERT INTO saved_stories (user_id, title, story_text, story_type, language, length_minutes,
+                                           modifications, rating, saved_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            '''
+            batch = []
+            for line in lines:
+                story = parse_story_line(line)
+                if story is None:
+                    if line.strip():
+                        counts['invalid'] += 1
+                    continue
+
+                key = story_key(story['title'], story['story_text'])
+                if key in seen:
+                    counts['duplicates'] += 1
+                    continue
+                seen.add(key)
+
+                batch.append((user_id, *(story[column] for column in STORY_COLUMNS), story['saved_at']))
+                if len(batch) >= batch_size:
+                    conn.executemany(insert, batch)
+                    conn.commit()
+                    counts['imported'] += len(batch)
+                    batch = []
+
+            if batch:
+                conn.executemany(insert, batch)
+                conn.commit()
+                counts['imported'] += len(batch)
+            return counts
+        finally:
+            conn.close()
+
+    # Story inbox
+
+    def claim_inbox_story(self, user_id, story_type, length_minutes, language, fingerprint):
+        """
+        Take a matching, unexpired story out of the user's inbox.
+
+        Returns:
+            dict with story_text and language, or None if nothing matches
+        """
+        conn = self._stories(user_id)
+        try:
+            row = conn.execute('''
+                SELECT id, story_text, language FROM story_inbox
+                WHERE user_id = ? AND story_type = ? AND length_minutes = ? AND language = ?
+                  AND settings_fingerprint = ? AND served_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+                ORDER BY created_at
+                LIMIT 1
+            ''', (user_id, story_type, length_minutes, language, fingerprint)).fetchone()
+            if not row:
+                return None
+
+            # Another worker may have claimed it in the meantime
+            claimed = conn.execute(
+                'UPDATE story_inbox SET served_at = CURRENT_TIMESTAMP WHERE id = ? AND served_at IS NULL',
+                (row['id'],)
+            )
+            conn.commit()
+            if claimed.rowcount == 0:
+                return None
+            return {"story_text": row['story_text'], "language": row['language']}
+        finally:
+            conn.close()
+
+    def add_inbox_story(self, user_id, story_type, length_minutes, language, fingerprint, story_text, ttl_hours):
+        conn = self._stories(user_id)
+        try:
+            conn.execute('''
+                INSERT INTO story_inbox (user_id, story_type, length_minutes, language, settings_fingerprint,
+                                         story_text, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))
+            ''', (user_id, story_type, length_minutes, language, fingerprint, story_text, f'+{ttl_hours} hours'))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def count_pending_inbox(self, user_id, story_type, length_minutes, language, fingerprint) -> int:
+        conn = self._stories(user_id)
+        try:
+            return conn.execute('''
+                SELECT COUNT(*) FROM story_inbox
+                WHERE user_id = ? AND story_type = ? AND length_minutes = ? AND language = ?
+                  AND settings_fingerprint = ? AND served_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+            ''', (user_id, story_type, length_minutes, language, fingerprint)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def purge_inbox(self, retention_days):
+        # Served and expired items are kept for the window so inbox_stats can count them
+        for path in self.story_paths:
+            conn = connect(path)
+            try:
+                conn.execute("DELETE FROM story_inbox WHERE created_at <= datetime('now', ?)",
+                             (f'-{retention_days} days',))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def inbox_stats(self, days):
+        stats = {"generated": 0, "served": 0, "expired": 0, "pending": 0}
+        for path in self.story_paths:
+            conn = connect(path)
+            try:
+                row = conn.execute('''
+                    SELECT COUNT(*) AS generated,
+                           COUNT(served_at) AS served,
+                           SUM(CASE WHEN served_at IS NULL AND expires_at <= CURRENT_TIMESTAMP THEN 1 ELSE 0 END) AS expired,
+                           SUM(CASE WHEN served_at IS NULL AND expires_at > CURRENT_TIMESTAMP THEN 1 ELSE 0 END) AS pending
+                    FROM story_inbox
+                    WHERE created_at > datetime('now', ?)
+                ''', (f'-{days} days',)).fetchone()
+                for key in stats:
+                    stats[key] += row[key] or 0
+            finally:
+                conn.close()
+        return stats
+
+    def record_activity(self, user_id):
+        conn = self._stories(user_id)
+        try:
+            conn.execute('INSERT OR REPLACE INTO user_activity (user_id, last_generated_at) VALUES (?, CURRENT_TIMESTAMP)',
+                         (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def active_user_ids(self, days):
+        user_ids = []
+        for path in self.story_paths:
+            conn = connect(path)
+            try:
+                rows = conn.execute('''
+                    SELECT user_id FROM user_activity WHERE last_generated_at > datetime('now', ?)
+                    UNION
+                    SELECT user_id FROM saved_stories WHERE saved_at > datetime('now', ?) AND user_id IS NOT NULL
+                    UNION
+                    SELECT user_id FROM story_inbox WHERE served_at > datetime('now', ?)
+                ''', (f'-{days} days',) * 3).fetchall()
+                user_ids.extend(row['user_id'] for row in rows)
+            finally:
+                conn.close()
+        return user_ids
+
+    def saved_lengths(self, user_id, story_type):
+        conn = self._stories(user_id)
+        try:
+            rows = conn.execute(
+                'SELECT length_minutes FROM saved_stories WHERE user_id = ? AND story_type = ? AND length_minutes IS NOT NULL',
+                (user_id, story_type)
+            ).fetchall()
+            return [row['length_minutes'] for row in rows]
+        finally:
+            conn.close()
+
+    # Calibration stats
+
+    def record_generation(self, stats: dict):
+        conn = self._stats()
+        try:
+            conn.execute(f'''
+                INSERT INTO generation_stats ({', '.join(GENERATION_COLUMNS)})
+                VALUES ({', '.join('?' * len(GENERATION_COLUMNS))})
+            ''', tuple(stats.get(column) for column in GENERATION_COLUMNS))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def generation_samples(self, model, story_type, length_minutes, limit):
+        conn = self._stats()
+        try:
+            rows = conn.execute('''
+                SELECT prompted_words, actual_words, completion_tokens, finish_reason
+                FROM generation_stats
+                WHERE model = ? AND story_type = ? AND (? IS NULL OR length_minutes = ?)
+                  AND prompted_words > 0 AND actual_words > 0
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (model, story_type, length_minutes, length_minutes, limit)).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    def generation_buckets(self, flat_max_tokens):
+        """
+        Returns:
+            list of dicts with generations, truncated, avg_target, avg_actual,
+            avg_completion and tokens_saved (reserved below flat_max_tokens)
+        """
+        conn = self._stats()
+        try:
+            rows = conn.execute('''
+                SELECT model, story_type, length_minutes, COUNT(*) AS generations,
+                       AVG(target_words) AS avg_target, AVG(actual_words) AS avg_actual,
+                       AVG(completion_tokens) AS avg_completion,
+                       SUM(CASE WHEN finish_reason = 'length' THEN 1 ELSE 0 END) AS truncated,
+                       SUM(? - COALESCE(max_tokens, ?)) AS tokens_saved
+                FROM generation_stats
+                GROUP BY model, story_type, length_minutes
+                ORDER BY model, story_type, length_minutes
+            ''', (flat_max_tokens, flat_max_tokens)).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    # Similarity index
+
+    def add_similarity_entry(self, scope, user_id, story_id, normalized_text, signature):
+        conn = self._directory()
+        try:
+            cursor = conn.execute('''
+                INSERT INTO similarity_index (scope, user_id, story_id, normalized_text, signature)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (scope, user_id, story_id, normalized_text, signature))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def similarity_entries_since(self, last_id):
+        conn = self._directory()
+        try:
+            rows = conn.execute(
+                'SELECT id, scope, user_id, story_id, signature FROM similarity_index WHERE id > ? ORDER BY id',
+                (last_id,)
+            ).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    def remove_similarity_entries(self, user_id, story_id):
+        conn = self._directory()
+        try:
+            rows = conn.execute(
+                'SELECT id FROM similarity_index WHERE user_id = ? AND story_id = ?', (user_id, story_id)
+            ).fetchall()
+            conn.execute('DELETE FROM similarity_index WHERE user_id = ? AND story_id = ?', (user_id, story_id))
+            conn.commit()
+            return [row['id'] for row in rows]
+        finally:
+            conn.close()
+
+    def remove_user_similarity_entries(self, user_id):
+        conn = self._directory()
+        try:
+            rows = conn.execute('SELECT id FROM similarity_index WHERE user_id = ?', (user_id,)).fetchall()
+            conn.execute('DELETE FROM similarity_index WHERE user_id = ?', (user_id,))
+            conn.commit()
+            return [row['id'] for row in rows]
+        finally:
+            conn.close()
+
+    def delete_similarity_entry(self, entry_id):
+        conn = self._directory()
+        try:
+            conn.execute('DELETE FROM similarity_index WHERE id = ?', (entry_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear_similarity_index(self):
+        conn = self._directory()
+        try:
+            conn.execute('DELETE FROM similarity_index')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class ShardedSQLiteRepository(SQLiteRepository):
+    """Auth and settings in a directory file, stats in their own file, stories sharded by user_id hash."""
+
+    def __init__(self, shard_dir=SHARD_DIR, shard_count=SHARD_COUNT):
+        os.makedirs(shard_dir, exist_ok=True)
+        super().__init__(os.path.join(shard_dir, DIRECTORY_FILE))
+        self.stats_path = os.path.join(shard_dir, STATS_FILE)
+        self.shard_count = shard_count
+        self.story_paths = [os.path.join(shard_dir, SHARD_FILE.format(i)) for i in range(shard_count)]
+
+    def init_schema(self):
+        # Changing the shard count would silently strand users on the wrong shard,
+        # so check it before any shard file is created or migrated
+        conn = self._directory()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)')
+            stored = conn.execute("SELECT value FROM storage_meta WHERE key = 'shard_count'").fetchone()
+            if stored and int(stored['value']) != self.shard_count:
+                raise RuntimeError(f"Shard directory was created with {stored['value']} shards, not {self.shard_count}")
+            if not stored:
+                conn.execute("INSERT INTO storage_meta (key, value) VALUES ('shard_count', ?)", (str(self.shard_count),))
+            conn.commit()
+        finally:
+            conn.close()
+
+        super().init_schema()
+
+    def _story_path(self, user_id):
+        return self.story_paths[shard_for(user_id, self.shard_count)]
+
+
+def get_repository() -> Repository:
+    """Build the repository selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == 'sharded':
+        return ShardedSQLiteRepository(SHARD_DIR, SHARD_COUNT)
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteRepository(DATABASE)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+
+def _copy_rows(source, table, targets, pick_target, batch_size=1000):
+    """
+    Copy every row of a table, keeping ids, into the target chosen per row.
+    Rows for which pick_target returns None are skipped.
+
+    Returns:
+        (rows copied, rows skipped)
+    """
+    if not source.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+        return 0, 0
+
+    cursor = source.execute(f'SELECT * FROM {table}')
+    columns = [description[0] for description in cursor.description]
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    copied = skipped = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            target = pick_target(row)
+            if target is None:
+                skipped += 1
+                continue
+            targets[target].execute(insert, tuple(row))
+            copied += 1
+    return copied, skipped
+
+
+def _owner_shard(shard_count):
+    """pick_target for per-user tables: the owner's shard, or None for rows without an owner."""
+    def pick(row):
+        # Stories saved before accounts existed have no user_id (or no column at all)
+        user_id = row['user_id'] if 'user_id' in row.keys() else None
+        if user_id is None:
+            return None
+        return shard_for(user_id, shard_count)
+    return pick
+
+
+def split_database(source_path, shard_dir, shard_count):
+    """
+    Split a single-file database into a sharded layout.
+
+    Auth, settings and the similarity index go to the directory file,
+    calibration stats to the stats file, and saved_stories, story_inbox and
+    user_activity rows to the shard of their user_id, keeping their ids. Rows without a
+    user_id (saved before accounts existed) belong to nobody and can't be
+    read through the app, so they are skipped and counted.
+
+    Everything is built in a temporary directory next to shard_dir and only
+    renamed into place once every row is copied, so a failed split leaves
+    nothing behind and can simply be retried. shard_dir must not exist or
+    be empty.
+
+    Returns:
+        dict of table name -> rows copied, plus <table>_skipped counts
+    """
+    if not os.path.exists(source_path):
+        raise RuntimeError(f"{source_path} does not exist")
+    shard_dir = os.path.abspath(shard_dir)
+    if os.path.exists(shard_dir) and os.listdir(shard_dir):
+        raise RuntimeError(f"{shard_dir} is not empty; split into a new directory")
+
+    parent = os.path.dirname(shard_dir)
+    os.makedirs(parent, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix='.split-', dir=parent)
+    try:
+        repo = ShardedSQLiteRepository(build_dir, shard_count)
+        repo.init_schema()
+
+        source = connect(source_path)
+        directory = connect(repo.path)
+        stats = connect(repo.stats_path)
+        shards = [connect(path) for path in repo.story_paths]
+        try:
+            copied = {}
+            for table, target in (('users', directory), ('user_settings', directory), ('generation_stats', stats)):
+                copied[table], _ = _copy_rows(source, table, [target], lambda row: 0)
+            # Pre-story_id index rows are dropped by init_global_schema anyway
+            copied['similarity_index'], _ = _copy_rows(source, 'similarity_index', [directory],
+                                                       lambda row: 0 if 'story_id' in row.keys() else None)
+            for table in ('saved_stories', 'story_inbox', 'user_activity'):
+                copied[table], skipped = _copy_rows(source, table, shards, _owner_shard(shard_count))
+                if skipped:
+                    copied[f'{table}_skipped'] = skipped
+
+            for conn in [directory, stats] + shards:
+                conn.commit()
+        finally:
+            for conn in [source, directory, stats] + shards:
+                conn.close()
+
+        if os.path.isdir(shard_dir):
+            os.rmdir(shard_dir)  # Checked empty above
+        os.rename(build_dir, shard_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    return copied
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'split':
+        print("Usage: python db.py split <stories.db> <shard_dir> <shard_count>")
+        sys.exit(1)
+
+    copied = split_database(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    for table, rows in copied.items():
+        if table.endswith('_skipped'):
+            print(f"{table[:-len('_skipped')]}: {rows} rows without a user_id skipped")
+        else:
+            print(f"{table}: {rows} rows")
+    print(f"Set STORAGE_BACKEND=sharded SHARD_DIR={sys.argv[3]} SHARD_COUNT={sys.argv[4]} to use it.")
@@ -0,0 +1,137 @@
+"""
+Per-user story inbox for Bedtime Story Generator
+
+Almost all /generate traffic lands in a short evening window, while the
+upstream quota sits idle the rest of the day. A batch job pre-generates (and
+pre-translates) a few personalized "original" stories per active user during
+off-peak hours and stores them here; /generate serves from the inbox first
+when a request matches.
+
+Schedule the batch job off-peak, e.g. with cron:
+
+    0 4 * * * cd /path/to/app && python inbox.py
+"""
+
+import hashlib
+import json
+import time
+from collections import Counter
+
+
+# =============================================================================
+# SETTINGS
+# =============================================================================
+
+INBOX_SIZE = 3  # Unserved stories kept ready per user
+INBOX_TTL_HOURS = 48  # Stories older than this are considered stale
+ACTIVE_DAYS = 14  # Users who generated, saved or were served a story this recently get pre-generation
+DEFAULT_LENGTH = 5  # Minutes, same default as /generate
+PREGENERATE_DELAY_SECONDS = 2  # Pause between upstream calls to stay under rate limits
+
+
+def settings_fingerprint(settings: dict) -> str:
+    """Hash the settings that shape a story, so edits invalidate old inbox items."""
+    settings = settings or {}
+    relevant = [settings.get(key) for key in
+                ('tones', 'tone_custom', 'favorite_topics', 'child_age', 'preferred_language')]
+    return hashlib.sha1(json.dumps(relevant).encode('utf-8')).hexdigest()
+
+
+def claim_inbox_story(repo, user_id, story_type, length_minutes, language, settings):
+    """
+    Take a matching, unexpired story out of the user's inbox.
+
+    Returns:
+        dict with story_text and language, or None if nothing matches
+    """
+    return repo.claim_inbox_story(user_id, story_type, length_minutes, language, settings_fingerprint(settings))
+
+
+def preferred_length(repo, user_id) -> int:
+    """The length the user most often saves original stories at."""
+    lengths = repo.saved_lengths(user_id, 'original')
+    if not lengths:
+        return DEFAULT_LENGTH
+    return Counter(lengths).most_common(1)[0][0]
+
+
+def get_inbox_stats(repo) -> dict:
+    """
+    How much of the pre-generated (off-peak) output was actually served over
+    the last ACTIVE_DAYS. Every served story is a peak-time upstream call saved.
+
+    Returns:
+        dict with generated, served, expired, pending and serve_rate
+    """
+    stats = repo.inbox_stats(ACTIVE_DAYS)
+    finished = stats['served'] + stats['expired']
+    stats['serve_rate'] = round(stats['served'] / finished, 3) if finished else 0.0
+    return stats
+
+
+def run_pregeneration():
+    """
+    Top up the inbox of every active user with saved settings to INBOX_SIZE
+    original stories.
+
+    Returns:
+        dict with users considered, stories generated and failures
+    """
+    # Imported here so the inbox helpers don't pull in the Flask app
+    from app import repo
+
+    summary = {"users": 0, "generated": 0, "failed": 0}
+    repo.purge_inbox(ACTIVE_DAYS)
+    for user_id in repo.active_user_ids(ACTIVE_DAYS):
+        settings = repo.get_settings(user_id)
+        if not settings:
+            continue
+        summary['users'] += 1
+        _top_up_inbox(repo, user_id, settings, summary)
+    return summary
+
+
+def _top_up_inbox(repo, user_id, settings, summary):
+    """Generate stories for one user until their inbox holds INBOX_SIZE."""
+    from app import generate_story
+    from translation import translate_story
+
+    language = settings.get('preferred_language') or 'English'
+    length = preferred_length(repo, user_id)
+    fingerprint = settings_fingerprint(settings)
+    pending = repo.count_pending_inbox(user_id, 'original', length, language, fingerprint)
+
+    for _ in range(INBOX_SIZE - pending):
+        result = generate_story('original', length, '', settings)
+        if not result.get('success'):
+            print(f"Pre-generation failed for user {user_id}: {result.get('error')}")
+            summary['failed'] += 1
+            return  # Likely quota/upstream trouble; move on to the next user
+        if result.get('truncated'):
+            print(f"Pre-generation for user {user_id} was cut off; not storing it")
+            summary['failed'] += 1
+            return
+
+        story = result['story']
+        if language != "English":
+            story = translate_story(story, language)
+            if story == result['story']:
+                # translate_story falls back to English on errors
+                print(f"Pre-translation failed for user {user_id}")
+                summary['failed'] += 1
+                return
+
+        repo.add_inbox_story(user_id, 'original', length, language, fingerprint, story, INBOX_TTL_HOURS)
+        summary['generated'] += 1
+        time.sleep(PREGENERATE_DELAY_SECONDS)
+
+
+if __name__ == '__main__':
+    summary = run_pregeneration()
+    print(f"Pre-generated {summary['generated']} stories for {summary['users']} active users "
+          f"({summary['failed']} failures)")
+
+    from app import repo
+    stats = get_inbox_stats(repo)
+    print(f"Last {ACTIVE_DAYS} days: {stats['generated']} pre-generated, {stats['served']} served, "
+          f"{stats['expired']} expired unserved, {stats['pending']} pending (serve rate {stats['serve_rate']})")
@@ -11,10 +11,22 @@ Modify this file to change story generation behavior without touching app.py.
 
 MODEL_NAME = "llama-3.3-70b-versatile"
 TEMPERATURE = 0.7  # Higher = more creative, lower = more predictable
-MAX_TOKENS = 2048
+MAX_TOKENS = 2048  # Hard ceiling; per-request budgets are sized below this
 WORDS_PER_MINUTE = 180  # Average reading speed for children's stories
 
 
+# =============================================================================
+# CALIBRATION SETTINGS (see calibration.py)
+# =============================================================================
+
+TOKENS_PER_WORD = 1.4  # Starting guess until enough completions are recorded
+MAX_TOKENS_HEADROOM = 1.3  # Extra budget so stories aren't cut off mid-sentence
+MIN_TOKENS = 256  # Never ask for less than this (title + a short story)
+CALIBRATION_MIN_SAMPLES = 5  # Completions needed before trusting learned factors
+CALIBRATION_WINDOW = 50  # Only the most recent completions per bucket are used
+WORD_FACTOR_RANGE = (0.5, 2.0)  # Clamp for the learned word-count correction
+
+
 # =============================================================================
 # SYSTEM PROMPT (AI Persona)
 # =============================================================================
@@ -31,12 +43,23 @@ Use simple vocabulary"""
 TITLE_INSTRUCTION = "Start with a creative title (less than 10 words) on its own line, then a blank line, then the story."
 
 
-def estimate_words_from_minutes(minutes: int) -> int:
-    """Estimate word count based on reading time."""
-    return int(minutes * WORDS_PER_MINUTE)
+def estimate_words_from_minutes(minutes: int, word_factor: float = 1.0) -> int:
+    """
+    Estimate word count based on reading time.
+
+    word_factor is the calibration correction for the model's tendency to
+    over- or undershoot the word count it is asked for (1.0 = no correction).
+    """
+    return int(minutes * WORDS_PER_MINUTE * word_factor)
+
+
+def estimate_max_tokens(word_count: int, tokens_per_word: float = TOKENS_PER_WORD) -> int:
+    """Size the completion budget for a story of word_count words."""
+    budget = int(word_count * tokens_per_word * MAX_TOKENS_HEADROOM)
+    return max(MIN_TOKENS, min(MAX_TOKENS, budget))
 
 
-def build_story_prompt(story_type: str, length_minutes: int, modifications: str = "", settings: dict = None, classic_tale_title: str = None) -> str:
+def build_story_prompt(story_type: str, length_minutes: int, modifications: str = "", settings: dict = None, classic_tale_title: str = None, word_factor: float = 1.0) -> str:
     """
     Build the user prompt for story generation (always in English).
     Translation to other languages is handled separately after generation.
@@ -47,18 +70,14 @@ def build_story_prompt(story_type: str, length_minutes: int, modifications: str
         modifications: User modifications for mixed story types
         settings: User settings dict with tones, favorite_topics, child_age
         classic_tale_title: Title of specific classic tale to use
+        word_factor: Calibration correction applied to the requested word count
 
     Returns:
         The complete prompt string to send to the LLM
     """
-    word_count = estimate_words_from_minutes(length_minutes)
+    word_count = estimate_words_from_minutes(length_minutes, word_factor)
 
-    # Build personalization instructions from settings
-    # For classic stories, only use age (for vocabulary), not tones/topics
-    if story_type == "classic" or story_type == "classic_mixed":
-        personalization = _build_age_only(settings)
-    else:
-        personalization = _build_personalization(settings)
+    personalization = build_personalization(story_type, settings)
 
     # Build prompt (always in English - translation happens after generation)
     if story_type == "original":
@@ -79,6 +98,14 @@ def build_story_prompt(story_type: str, length_minutes: int, modifications: str
     return prompt
 
 
+def build_personalization(story_type: str, settings: dict = None) -> str:
+    """Build the personalization fragment of the prompt for this story type."""
+    # For classic stories, only use age (for vocabulary), not tones/topics
+    if story_type == "classic" or story_type == "classic_mixed":
+        return _build_age_only(settings)
+    return _build_personalization(settings)
+
+
 def _build_age_only(settings: dict) -> str:
     """Build age-only personalization for classic stories."""
     if not settings:
@@ -0,0 +1,343 @@
+"""
+Near-duplicate detection for "original_about" requests
+
+Many original_about requests ask for essentially the same story ("a dinosaur
+who can't sleep", "dinosaur that cannot fall asleep"). Exact-key caching never
+hits them. This module keeps a MinHash/LSH index over the word and
+character shingles of the normalized modifications text of highly rated
+saved stories. When a new request is similar enough, /generate returns that
+story instead of calling Groq.
+
+Only stories with the same personalization fragment, length, language and
+negated words are candidates, so "won't sleep" never matches "will sleep". The index is persisted through the repository (db.py) so every
+worker (and restart) sees the same entries; only ids and signatures are kept
+in memory. Each hit is re-checked against saved_stories, so deleted or
+down-rated stories are never served.
+
+A hit hands one user's saved story (title, text and whatever the request
+said, which may include a child's name) to another user. Only stories whose
+owner turned on share_stories in their settings are indexed, and consent is
+checked again before each hit is served.
+
+Opt-in: set SIMILARITY_ENABLED=1. Tune with SIMILARITY_THRESHOLD (0-1).
+Stories are indexed when saved or rated highly. Index the stories saved
+before the feature was enabled (or rebuild after changing the matching) with:
+
+    python similarity.py rebuild
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import zlib
+
+from llm_config import build_personalization
+
+
+# =============================================================================
+# SETTINGS
+# =============================================================================
+
+SIMILARITY_ENABLED = os.environ.get('SIMILARITY_ENABLED', '0') in ('1', 'true')
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', 0.75))  # Chosen from tests/test_similarity.py
+MIN_RATING = 4  # Only saved stories rated at least this are reused
+NUM_PERMUTATIONS = 128
+BANDS = 32  # NUM_PERMUTATIONS / BANDS rows per band; candidates share at least one band
+SHINGLE_SIZE = 3  # Character shingles catch spelling variants that word shingles miss
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)  # Fixed seed: signatures must match across processes
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+_STOPWORDS = {'a', 'an', 'the', 'who', 'that', 'which', 'is', 'are', 'was', 'be', 'of', 'to', 'and', 'about',
+              'story', 'little', 'will', 'would', 'can', 'could', 'do', 'does', 'did'}
+# The word after one of these is negated ("not_sleep"); see negated_terms()
+_NEGATIONS = {'not', 'no', 'never', 'cannot', 'without'}
+_CONTRACTIONS = {"can't": "cannot", "cant": "cannot", "won't": "will not", "wont": "will not"}
+# Common ways of saying the same thing in bedtime requests
+_PHRASES = {"falling asleep": "sleep", "fall asleep": "sleep", "asleep": "sleep"}
+
+
+def shares_stories(settings) -> bool:
+    """Whether the owner of these settings agreed to other users getting their saved stories."""
+    return bool(settings and settings.get('share_stories'))
+
+
+def _stem(word: str) -> str:
+    """Strip a plural or -ing ending so "dinosaurs"/"dinosaur" and "learns"/"learning" match."""
+    for suffix in ('ing', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3 and not word.endswith('ss'):
+            return word[:-len(suffix)]
+    return word
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase, expand contractions, drop punctuation and filler words, stem,
+    and mark the word after a negation: "a dinosaur that won't sleep"
+    becomes "dinosaur not_sleep".
+    """
+    text = (text or '').lower().replace('’', "'")
+    for contraction, expanded in _CONTRACTIONS.items():
+        text = re.sub(rf"\b{re.escape(contraction)}\b", expanded, text)
+    text = re.sub(r"n't\b", " not", text)
+    for phrase, replacement in _PHRASES.items():
+        text = re.sub(rf"\b{re.escape(phrase)}\b", replacement, text)
+
+    words = []
+    negate = False
+    for word in re.sub(r"[^a-z0-9\s]", " ", text).split():
+        if word in _NEGATIONS:
+            negate = True
+            continue
+        if word in _STOPWORDS:
+            continue
+        word = _stem(word)
+        words.append(f'not_{word}' if negate else word)
+        negate = False
+    return ' '.join(words)
+
+
+def negated_terms(text: str) -> list:
+    """The negated words of normalized text. Requests only match if these are identical."""
+    return sorted({word for word in text.split() if word.startswith('not_')})
+
+
+def scope_key(personalization: str, length_minutes, language, negated=()) -> str:
+    """
+    Requests are only compared within the same personalization, length,
+    language and negated words: "won't sleep" and "will sleep" share most
+    shingles but ask for opposite stories.
+    """
+    # Saved stories and requests don't agree on types/defaults, so normalize them
+    length_minutes = int(length_minutes) if length_minutes else None
+    language = language or 'English'
+    return hashlib.sha1(json.dumps([personalization, length_minutes, language, list(negated)]).encode('utf-8')).hexdigest()
+
+
+def shingles(text: str) -> set:
+    """Word unigrams and bigrams plus character shingles of normalized text."""
+    words = text.split()
+    result = {f'w:{word}' for word in words}
+    result |= {f'b:{first} {second}' for first, second in zip(words, words[1:])}
+    if len(text) <= SHINGLE_SIZE:
+        result.add(f'c:{text}')
+    else:
+        result |= {f'c:{text[i:i + SHINGLE_SIZE]}' for i in range(len(text) - SHINGLE_SIZE + 1)}
+    return result
+
+
+def minhash(text: str) -> list:
+    """MinHash signature of the shingles of normalized text."""
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def estimate_similarity(signature_a: list, signature_b: list) -> float:
+    """Estimated Jaccard similarity: the fraction of matching signature slots."""
+    matches = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return matches / len(signature_a)
+
+
+def _band_keys(scope: str, signature: list):
+    rows = NUM_PERMUTATIONS // BANDS
+    return [(scope, band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(BANDS)]
+
+
+class SimilarityIndex:
+    """In-memory LSH index (ids and signatures only) backed by the similarity_index table."""
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = {}  # id -> (scope, signature, user_id, story_id)
+        self._buckets = {}  # band key -> set of ids
+        self._last_id = 0
+        self.counters = {"lookups": 0, "hits": 0, "misses": 0, "indexed": 0, "evicted": 0}
+        self._hit_similarity_total = 0.0
+        self._best_similarity_total = 0.0
+
+    def refresh(self, repo):
+        """Load entries added since the last refresh (possibly by other workers)."""
+        rows = repo.similarity_entries_since(self._last_id)
+        with self._lock:
+            for row in rows:
+                self._add(row['id'], row['scope'], json.loads(row['signature']), row['user_id'], row['story_id'])
+
+    def add(self, repo, user_id, story_id, modifications, personalization, length_minutes, language) -> bool:
+        """Index a highly rated saved story. Returns False if the request text is empty after normalizing."""
+        text = normalize(modifications)
+        if not text:
+            return False
+        scope = scope_key(personalization, length_minutes, language, negated_terms(text))
+        repo.add_similarity_entry(scope, user_id, story_id, text, json.dumps(minhash(text)))
+        # Picked up by the next refresh(), in id order with other workers' entries
+        with self._lock:
+            self.counters['indexed'] += 1
+        return True
+
+    def index_story(self, repo, story, settings=None, replace=True) -> bool:
+        """
+        Index a saved story if it qualifies: original_about, rated at least
+        MIN_RATING, and its owner shares stories.
+
+        Args:
+            story: Saved story dict (id, user_id, story_type, rating, modifications, length_minutes, language)
+            settings: The owner's settings, if already loaded
+            replace: Drop any existing entries for the story first, so a
+                re-rated story that no longer qualifies leaves the index
+
+        Returns:
+            True if the story was indexed
+        """
+        if replace:
+            self.remove(repo, story['user_id'], story['id'])
+        if story['story_type'] != "original_about" or (story['rating'] or 0) < MIN_RATING:
+            return False
+        if settings is None:
+            settings = repo.get_settings(story['user_id'])
+        if not shares_stories(settings):
+            return False
+        return self.add(repo, story['user_id'], story['id'], story['modifications'],
+                        build_personalization("original_about", settings), story['length_minutes'], story['language'])
+
+    def remove(self, repo, user_id, story_id):
+        """Drop a saved story from the index, e.g. when it is deleted or down-rated."""
+        entry_ids = repo.remove_similarity_entries(user_id, story_id)
+        with self._lock:
+            for entry_id in entry_ids:
+                self._evict(entry_id)
+
+    def remove_user(self, repo, user_id):
+        """Drop all of a user's stories, e.g. when they stop sharing."""
+        entry_ids = repo.remove_user_similarity_entries(user_id)
+        with self._lock:
+            for entry_id in entry_ids:
+                self._evict(entry_id)
+
+    def lookup(self, repo, user_id, modifications, personalization, length_minutes, language):
+        """
+        Find the most similar indexed story from another user that is still
+        saved, still rated at least MIN_RATING and whose owner still shares
+        stories. Entries that fail that check (other workers may have deleted
+        the story) are evicted.
+
+        Returns:
+            dict with title, story_text, language and similarity, or None
+        """
+        self.refresh(repo)
+        text = normalize(modifications)
+        scope = scope_key(personalization, length_minutes, language, negated_terms(text))
+        signature = minhash(text) if text else None
+
+        matches = []
+        with self._lock:
+            self.counters['lookups'] += 1
+            if signature:
+                candidates = set()
+                for key in _band_keys(scope, signature):
+                    candidates |= self._buckets.get(key, set())
+                for entry_id in candidates:
+                    _, entry_signature, entry_user_id, story_id = self._entries[entry_id]
+                    # The requesting user wants a new story, not one of their own
+                    if user_id is not None and str(entry_user_id) == str(user_id):
+                        continue
+                    matches.append((estimate_similarity(signature, entry_signature), entry_id, entry_user_id, story_id))
+        matches.sort(reverse=True)
+
+        best_similarity = matches[0][0] if matches else 0.0
+        for similarity, entry_id, entry_user_id, story_id in matches:
+            if similarity < self.threshold:
+                break
+            story = repo.get_story(entry_user_id, story_id)
+            if story and (story['rating'] or 0) >= MIN_RATING and shares_stories(repo.get_settings(entry_user_id)):
+                with self._lock:
+                    self.counters['hits'] += 1
+                    self._hit_similarity_total += similarity
+                    self._best_similarity_total += best_similarity
+                return {"title": story['title'], "story_text": story['story_text'],
+                        "language": story['language'], "similarity": similarity}
+            # Gone, down-rated or no longer shared (possibly via another worker): stop considering it
+            with self._lock:
+                self._evict(entry_id)
+            repo.delete_similarity_entry(entry_id)
+
+        with self._lock:
+            self.counters['misses'] += 1
+            self._best_similarity_total += best_similarity
+        return None
+
+    def stats(self) -> dict:
+        """Hit rate and similarity metrics for this worker."""
+        with self._lock:
+            lookups = self.counters['lookups']
+            hits = self.counters['hits']
+            return {
+                "enabled": SIMILARITY_ENABLED,
+                "threshold": self.threshold,
+                "entries": len(self._entries),
+                "counters": dict(self.counters),
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "avg_hit_similarity": round(self._hit_similarity_total / hits, 3) if hits else 0.0,
+                "avg_best_similarity": round(self._best_similarity_total / lookups, 3) if lookups else 0.0
+            }
+
+    def _add(self, entry_id, scope, signature, user_id, story_id):
+        self._entries[entry_id] = (scope, signature, user_id, story_id)
+        for key in _band_keys(scope, signature):
+            self._buckets.setdefault(key, set()).add(entry_id)
+        self._last_id = max(self._last_id, entry_id)
+
+    def _evict(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if not entry:
+            return
+        scope, signature, _, _ = entry
+        for key in _band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+        self.counters['evicted'] += 1
+
+
+def rebuild_index(repo) -> dict:
+    """
+    Re-index every qualifying saved story from scratch, across all story
+    databases. Running workers keep serving their loaded entries (each is
+    still verified on a hit) and pick up the new ones on their next lookup.
+
+    Returns:
+        dict with candidate stories and how many were indexed
+    """
+    index = SimilarityIndex()
+    repo.clear_similarity_index()
+    summary = {"stories": 0, "indexed": 0}
+    owner_id, settings = None, None
+    for story in repo.iter_rated_stories("original_about", MIN_RATING):
+        summary['stories'] += 1
+        # Stories come grouped by user, so each owner's settings are read once
+        if story['user_id'] != owner_id:
+            owner_id, settings = story['user_id'], repo.get_settings(story['user_id'])
+        if index.index_story(repo, story, settings, replace=False):
+            summary['indexed'] += 1
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        print("Usage: python similarity.py rebuild")
+        sys.exit(1)
+
+    from db import get_repository
+
+    repo = get_repository()
+    repo.init_schema()
+    summary = rebuild_index(repo)
+    print(f"Indexed {summary['indexed']} of {summary['stories']} highly rated original_about stories "
+          f"(the rest have no request text or their owner doesn't share stories)")
@@ -0,0 +1,18 @@
+import admission
+from admission import ACCEPT, DEGRADE, REJECT, AdmissionController
+
+
+def test_degrade_is_not_counted_until_something_is_degraded():
+    controller = AdmissionController()
+    decisions = [controller.admit(authenticated=True) for _ in range(admission.MAX_IN_FLIGHT + 1)]
+
+    assert decisions[:admission.DEGRADE_IN_FLIGHT] == [ACCEPT] * admission.DEGRADE_IN_FLIGHT
+    assert set(decisions[admission.DEGRADE_IN_FLIGHT:-1]) == {DEGRADE}
+    assert decisions[-1] == REJECT
+    assert controller.stats()['counters'] == {
+        'accepted': admission.DEGRADE_IN_FLIGHT,
+        'rejected_authenticated': 1
+    }
+
+    controller.count('degraded_shorter_length')
+    assert controller.stats()['counters']['degraded_shorter_length'] == 1
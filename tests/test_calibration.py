@@ -0,0 +1,60 @@
+from calibration import get_calibration, record_generation, token_budget
+from db import SQLiteRepository
+from llm_config import CALIBRATION_MIN_SAMPLES, MAX_TOKENS, TOKENS_PER_WORD, estimate_words_from_minutes
+
+
+class Usage:
+    def __init__(self, completion_tokens):
+        self.prompt_tokens = 300
+        self.completion_tokens = completion_tokens
+
+
+def simulate(repo, length_minutes, overshoot, tokens_per_word=1.3):
+    """One generation by a model that writes `overshoot` times the words it is asked for."""
+    calibration = get_calibration(repo, 'model', 'original', length_minutes)
+    target_words = estimate_words_from_minutes(length_minutes)
+    prompted_words = estimate_words_from_minutes(length_minutes, calibration['word_factor'])
+    max_tokens = token_budget(calibration, target_words)
+
+    words = int(prompted_words * overshoot)
+    finish_reason = 'stop'
+    if words * tokens_per_word > max_tokens:
+        words = int(max_tokens / tokens_per_word)
+        finish_reason = 'length'
+    story = 'Title\n' + 'word ' * words
+    record_generation(repo, 'model', 'original', length_minutes, target_words, prompted_words, story,
+                      max_tokens, Usage(int(words * tokens_per_word)), finish_reason)
+    return finish_reason
+
+
+def test_uncalibrated_requests_get_full_budget(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / 'stories.db'))
+    repo.init_schema()
+
+    calibration = get_calibration(repo, 'model', 'original', 1)
+    assert calibration['source'] == 'default'
+    assert calibration['tokens_per_word'] == TOKENS_PER_WORD
+    assert token_budget(calibration, estimate_words_from_minutes(1)) == MAX_TOKENS
+
+
+def test_sparse_bucket_uses_pooled_calibration(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / 'stories.db'))
+    repo.init_schema()
+    for _ in range(CALIBRATION_MIN_SAMPLES):
+        simulate(repo, 5, overshoot=1.5)
+
+    calibration = get_calibration(repo, 'model', 'original', 3)
+    assert calibration['source'] == 'pooled'
+    assert round(calibration['word_factor'], 2) == 0.67
+    assert round(calibration['tokens_per_word'], 2) == 1.3
+    assert get_calibration(repo, 'model', 'original', 5)['source'] == 'bucket'
+    assert get_calibration(repo, 'model', 'classic', 5)['source'] == 'default'
+
+
+def test_overshooting_model_is_never_truncated(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / 'stories.db'))
+    repo.init_schema()
+
+    finish_reasons = [simulate(repo, length, overshoot=1.5) for length in (1, 1, 2, 3, 1, 2, 3, 5, 3, 1, 2)]
+    assert 'length' not in finish_reasons
+    assert token_budget(get_calibration(repo, 'model', 'original', 1), estimate_words_from_minutes(1)) < MAX_TOKENS
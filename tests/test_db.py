@@ -0,0 +1,194 @@
+import os
+import sqlite3
+
+import pytest
+
+import db
+from db import Repository, ShardedSQLiteRepository, SQLiteRepository, shard_for, split_database
+
+
+def make_legacy_database(path, extra_story_column=False):
+    """A stories.db from before accounts: saved_stories without user_id, added later by ALTER."""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            display_name TEXT,
+            token TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE saved_stories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            story_text TEXT NOT NULL,
+            story_type TEXT,
+            language TEXT,
+            length_minutes INTEGER,
+            modifications TEXT,
+            rating INTEGER CHECK(rating >= 1 AND rating <= 5),
+            saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE user_settings (
+            user_id INTEGER PRIMARY KEY,
+            tones TEXT,
+            tone_custom TEXT,
+            favorite_topics TEXT,
+            child_age INTEGER DEFAULT 6
+        )
+    ''')
+    conn.execute("INSERT INTO saved_stories (title, story_text, rating) VALUES ('Old', 'Before accounts', 5)")
+    conn.execute('ALTER TABLE saved_stories ADD COLUMN user_id INTEGER')
+    conn.execute("ALTER TABLE user_settings ADD COLUMN preferred_language TEXT DEFAULT 'English'")
+    if extra_story_column:
+        conn.execute('ALTER TABLE saved_stories ADD COLUMN narrator TEXT')
+
+    for user_id in range(1, 9):
+        conn.execute('INSERT INTO users (id, email, password_hash) VALUES (?, ?, ?)',
+                     (user_id, f'user{user_id}@example.com', 'hash'))
+        conn.execute("INSERT INTO user_settings (user_id, child_age) VALUES (?, 5)", (user_id,))
+        conn.execute('INSERT INTO saved_stories (user_id, title, story_text, rating) VALUES (?, ?, ?, 4)',
+                     (user_id, f'Story {user_id}', f'Text {user_id}'))
+    conn.execute("INSERT INTO saved_stories (title, story_text) VALUES ('Orphan', 'No owner either')")
+    conn.commit()
+    conn.close()
+
+
+def test_repository_is_abstract():
+    with pytest.raises(TypeError):
+        Repository()
+
+
+def test_split_skips_stories_without_owner(tmp_path):
+    source = tmp_path / 'stories.db'
+    make_legacy_database(source)
+    # The single-file app migrates the legacy file on startup
+    SQLiteRepository(str(source)).init_schema()
+
+    copied = split_database(str(source), str(tmp_path / 'shards'), 3)
+
+    assert copied['users'] == 8
+    assert copied['user_settings'] == 8
+    assert copied['saved_stories'] == 8
+    assert copied['saved_stories_skipped'] == 2
+    assert 'story_inbox_skipped' not in copied
+
+    repo = ShardedSQLiteRepository(str(tmp_path / 'shards'), 3)
+    repo.init_schema()
+    for user_id in range(1, 9):
+        stories = repo.list_stories(user_id)
+        assert [story['title'] for story in stories] == [f'Story {user_id}']
+        assert repo.get_settings(user_id)['child_age'] == 5
+
+    # Each story landed only on its owner's shard, keeping its id
+    for index, path in enumerate(repo.story_paths):
+        conn = db.connect(path)
+        for row in conn.execute('SELECT id, user_id FROM saved_stories'):
+            assert shard_for(row['user_id'], 3) == index
+            assert row['id'] == row['user_id'] + 1
+        conn.close()
+
+
+def test_split_without_prior_migration(tmp_path):
+    source = tmp_path / 'stories.db'
+    make_legacy_database(source)
+
+    copied = split_database(str(source), str(tmp_path / 'shards'), 2)
+
+    assert copied['saved_stories'] == 8
+    assert copied['saved_stories_skipped'] == 2
+    assert copied['story_inbox'] == 0
+
+
+def test_failed_split_leaves_nothing_behind(tmp_path):
+    source = tmp_path / 'stories.db'
+    make_legacy_database(source, extra_story_column=True)
+    shard_dir = tmp_path / 'shards'
+
+    with pytest.raises(sqlite3.OperationalError):
+        split_database(str(source), str(shard_dir), 2)
+    assert sorted(os.listdir(tmp_path)) == ['stories.db']
+
+    # Fix the source and retry into the same directory
+    conn = sqlite3.connect(source)
+    conn.execute('ALTER TABLE saved_stories DROP COLUMN narrator')
+    conn.commit()
+    conn.close()
+    copied = split_database(str(source), str(shard_dir), 2)
+    assert copied['saved_stories'] == 8
+    assert sorted(os.listdir(shard_dir)) == ['directory.db', 'stats.db', 'stories-0.db', 'stories-1.db']
+
+
+def test_split_into_empty_directory(tmp_path):
+    source = tmp_path / 'stories.db'
+    make_legacy_database(source)
+    shard_dir = tmp_path / 'shards'
+    shard_dir.mkdir()
+
+    split_database(str(source), str(shard_dir), 2)
+    assert 'directory.db' in os.listdir(shard_dir)
+
+
+def test_split_refuses_non_empty_directory(tmp_path):
+    source = tmp_path / 'stories.db'
+    make_legacy_database(source)
+    shard_dir = tmp_path / 'shards'
+    shard_dir.mkdir()
+    (shard_dir / 'directory.db').write_bytes(b'')
+
+    with pytest.raises(RuntimeError):
+        split_database(str(source), str(shard_dir), 2)
+    assert os.listdir(shard_dir) == ['directory.db']
+
+
+def test_sharded_repository_keeps_stats_out_of_directory(tmp_path):
+    repo = ShardedSQLiteRepository(str(tmp_path), 2)
+    repo.init_schema()
+    repo.record_generation({"model": "m", "story_type": "original", "length_minutes": 5,
+                            "prompted_words": 900, "actual_words": 850, "max_tokens": 1500})
+
+    assert repo.generation_samples('m', 'original', 5, 10)[0]['actual_words'] == 850
+    conn = db.connect(repo.path)
+    tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    assert 'generation_stats' not in tables
+
+
+def test_inbox_claim_is_single_use(tmp_path):
+    repo = ShardedSQLiteRepository(str(tmp_path), 2)
+    repo.init_schema()
+    repo.add_inbox_story(7, 'original', 5, 'English', 'fp', 'Title\n\nBody', 48)
+
+    assert repo.count_pending_inbox(7, 'original', 5, 'English', 'fp') == 1
+    assert repo.claim_inbox_story(7, 'original', 5, 'English', 'other-fp') is None
+    assert repo.claim_inbox_story(7, 'original', 5, 'English', 'fp')['story_text'] == 'Title\n\nBody'
+    assert repo.claim_inbox_story(7, 'original', 5, 'English', 'fp') is None
+    assert repo.active_user_ids(14) == [7]
+
+
+def test_users_who_only_generate_are_active(tmp_path):
+    repo = ShardedSQLiteRepository(str(tmp_path), 2)
+    repo.init_schema()
+    repo.record_activity(3)
+    repo.record_activity(3)
+    repo.save_story(4, {"title": "T", "story_text": "Body", "rating": 5})
+
+    assert sorted(repo.active_user_ids(14)) == [3, 4]
+
+
+def test_inbox_stats_count_served_and_expired(tmp_path):
+    repo = ShardedSQLiteRepository(str(tmp_path), 2)
+    repo.init_schema()
+    for user_id in (1, 2):
+        repo.add_inbox_story(user_id, 'original', 5, 'English', 'fp', 'Story', 48)
+    repo.add_inbox_story(1, 'original', 5, 'English', 'fp', 'Stale story', 0)
+    repo.claim_inbox_story(1, 'original', 5, 'English', 'fp')
+
+    # Served and expired items survive the purge so they can be counted
+    repo.purge_inbox(14)
+    assert repo.inbox_stats(14) == {"generated": 3, "served": 1, "expired": 1, "pending": 1}
@@ -0,0 +1,128 @@
+import pytest
+
+from db import ShardedSQLiteRepository, SQLiteRepository
+from llm_config import build_personalization
+from similarity import (
+    SIMILARITY_THRESHOLD, SimilarityIndex, estimate_similarity, minhash, negated_terms, normalize, rebuild_index,
+    scope_key
+)
+
+# Requests that should get the same story
+SAME = [
+    ("a dinosaur who can't sleep", "dinosaur that cannot fall asleep"),
+    ("A dinosaur that can't sleep!", "a dinosaur who can't sleep"),
+    ("little bunny afraid of the dark", "a bunny who is afraid of the dark"),
+    ("a cat who wants to fly to the moon", "cat that wants to fly to the moon"),
+    ("dragon who is scared of the dark", "a dragon scared of the dark"),
+    ("a robot learning to dance", "a robot who learns to dance"),
+    ("two dinosaurs who are best friends", "two dinosaur best friends"),
+]
+
+# Requests that must never share a story
+DIFFERENT = [
+    ("dinosaur that won't sleep", "dinosaur that will sleep"),
+    ("can't sleep", "can't swim"),
+    ("cat cannot sleep", "dog cannot sleep"),
+    ("a princess who loves pizza", "a princess who hates pizza"),
+    ("bunny afraid of the dark", "bunny afraid of water"),
+    ("a cat who wants to fly to the moon", "a dog who wants to fly to the moon"),
+    ("a unicorn who loves rainbows", "a unicorn who loves cupcakes"),
+    ("a dragon who is scared of the dark", "a dragon who is scared of knights"),
+    ("a puppy who doesn't want to take a bath", "a puppy who wants to take a bath"),
+    ("a robot learning to dance", "a robot learning to cook"),
+]
+
+
+def similarity(first, second):
+    """What the index compares: 0 across scopes, otherwise the MinHash estimate."""
+    first, second = normalize(first), normalize(second)
+    if scope_key('', 5, 'English', negated_terms(first)) != scope_key('', 5, 'English', negated_terms(second)):
+        return 0.0
+    return estimate_similarity(minhash(first), minhash(second))
+
+
+def test_normalize_marks_negated_words():
+    assert normalize("A dinosaur that won't sleep!") == 'dinosaur not_sleep'
+    assert normalize("a dinosaur who cannot fall asleep") == 'dinosaur not_sleep'
+    assert negated_terms(normalize("a puppy who doesn't want a bath")) == ['not_want']
+
+
+@pytest.mark.parametrize('first, second', SAME)
+def test_same_requests_match(first, second):
+    assert similarity(first, second) >= SIMILARITY_THRESHOLD
+
+
+@pytest.mark.parametrize('first, second', DIFFERENT)
+def test_different_requests_do_not_match(first, second):
+    assert similarity(first, second) < SIMILARITY_THRESHOLD
+
+
+def test_threshold_leaves_a_margin_above_different_requests():
+    # Serving the wrong story is worse than an extra upstream call, so the
+    # threshold stays clear of the closest different pair (plus MinHash
+    # estimation error). Close paraphrases such as "loves pizza" vs. "loves
+    # eating pizza" (about 0.65) are deliberately left as misses.
+    assert max(similarity(*pair) for pair in DIFFERENT) + 0.1 <= SIMILARITY_THRESHOLD
+
+
+def test_only_shared_stories_are_served(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / 'stories.db'))
+    repo.init_schema()
+    repo.save_settings(1, {"child_age": 6, "share_stories": 1})
+    story_id = repo.save_story(1, {"title": "Dino", "story_text": "Once upon a time", "story_type": "original_about",
+                                   "length_minutes": 5, "language": "English",
+                                   "modifications": "a dinosaur who can't sleep", "rating": 5})
+    index = SimilarityIndex()
+    index.add(repo, 1, story_id, "a dinosaur who can't sleep", '', 5, 'English')
+
+    match = index.lookup(repo, None, "dinosaur that cannot fall asleep", '', 5, 'English')
+    assert match['title'] == 'Dino'
+    # Never the requesting user's own story
+    assert index.lookup(repo, 1, "dinosaur that cannot fall asleep", '', 5, 'English') is None
+
+    # Consent withdrawn (e.g. by another worker): the entry is dropped, not served
+    repo.save_settings(1, {"child_age": 6, "share_stories": 0})
+    assert index.lookup(repo, 2, "dinosaur that cannot fall asleep", '', 5, 'English') is None
+    assert index.stats()['entries'] == 0
+    assert repo.similarity_entries_since(0) == []
+
+
+def save_about_story(repo, user_id, modifications, rating):
+    return repo.save_story(user_id, {"title": modifications.title(), "story_text": "Once upon a time",
+                                     "story_type": "original_about", "length_minutes": 5, "language": "English",
+                                     "modifications": modifications, "rating": rating})
+
+
+def test_rebuild_indexes_existing_shared_stories(tmp_path):
+    repo = ShardedSQLiteRepository(str(tmp_path), 3)
+    repo.init_schema()
+    for user_id in range(1, 7):
+        repo.save_settings(user_id, {"child_age": 6, "share_stories": 1 if user_id != 6 else 0})
+        save_about_story(repo, user_id, f"a dinosaur who can't sleep number {user_id}", 5)
+        save_about_story(repo, user_id, "a dragon scared of the dark", 2)
+    save_about_story(repo, 7, "a bunny afraid of the dark", 5)  # No settings saved: doesn't share
+
+    assert rebuild_index(repo) == {"stories": 7, "indexed": 5}
+    # Rebuilding again replaces the entries instead of duplicating them
+    assert rebuild_index(repo) == {"stories": 7, "indexed": 5}
+    assert len(repo.similarity_entries_since(0)) == 5
+
+
+def test_up_rated_story_is_indexed(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / 'stories.db'))
+    repo.init_schema()
+    repo.save_settings(1, {"child_age": 6, "share_stories": 1})
+    story_id = save_about_story(repo, 1, "a robot learning to dance", 3)
+    index = SimilarityIndex()
+    assert not index.index_story(repo, repo.get_story(1, story_id))
+
+    repo.update_rating(1, story_id, 5)
+    assert index.index_story(repo, repo.get_story(1, story_id))
+    # Matched within the personalization the owner's settings produce
+    personalization = build_personalization("original_about", repo.get_settings(1))
+    match = index.lookup(repo, 2, "a robot who learns to dance", personalization, 5, 'English')
+    assert match['title'] == 'A Robot Learning To Dance'
+
+    repo.update_rating(1, story_id, 1)
+    assert not index.index_story(repo, repo.get_story(1, story_id))
+    assert repo.similarity_entries_since(0) == []